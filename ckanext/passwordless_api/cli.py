@@ -0,0 +1,174 @@
+"""CLI commands for ckanext-passwordless_api."""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from glob import escape as glob_escape
+from glob import glob
+from threading import Lock
+from time import perf_counter, sleep
+
+import click
+
+# Action -> (HTTP method, authenticated)
+REPLAY_ACTIONS = {
+    "passwordless_request_reset_key": ("POST", False),
+    "passwordless_request_api_token": ("POST", False),
+    "passwordless_refresh_api_token": ("POST", False),
+    "passwordless_revoke_api_token": ("POST", False),
+    "passwordless_get_user": ("GET", True),
+    "passwordless_introspect": ("GET", True),
+    "passwordless_revocation_list": ("GET", False),
+}
+
+
+def _find_trace_files(paths):
+    """Find the trace files to replay.
+
+    A path can be the configured passwordless_api.trace_file, to replay the
+    files of all processes (see trace.process_trace_file), including
+    rotated files. Other paths are used as is.
+    """
+    trace_files = set()
+    for path in paths:
+        if os.path.isfile(path):
+            trace_files.add(path)
+        root, ext = os.path.splitext(path)
+        trace_files.update(glob(f"{glob_escape(root)}.*{glob_escape(ext)}*"))
+    return sorted(trace_files)
+
+
+def _load_records(trace_files):
+    """Load trace records from JSON lines files, sorted by start time."""
+    records = []
+    for trace_file in trace_files:
+        with open(trace_file) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record["start"])
+
+
+def _request_data(record):
+    """Build request data for a trace record.
+
+    Emails are hashed in traces, so a stable fake email is used per hash.
+    Keys and tokens are not recorded, so invalid values are sent.
+    """
+    action = record["action"]
+    email = f"replay-{record.get('email') or 'anonymous'}@example.com"
+    if action == "passwordless_request_reset_key":
+        return {"email": email}
+    if action == "passwordless_request_api_token":
+        return {"email": email, "key": "replay"}
+    if action == "passwordless_refresh_api_token":
+        return {"refresh_token": "replay.replay"}
+    if action == "passwordless_revoke_api_token":
+        return {"token": "replay"}
+    return None
+
+
+def _percentile(values, percent):
+    """Nearest rank percentile of sorted values."""
+    index = max(0, int(round(percent / 100 * len(values))) - 1)
+    return values[index]
+
+
+@click.group(short_help="Passwordless API commands.")
+def passwordless_api():
+    """Passwordless API commands."""
+    pass
+
+
+@passwordless_api.command()
+@click.argument("trace_files", nargs=-1, required=True, type=click.Path())
+@click.option("--url", default="http://localhost:5000", help="CKAN instance URL.")
+@click.option(
+    "--speed",
+    default=1.0,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Replay speed, e.g. 2 replays twice as fast as recorded.",
+)
+@click.option(
+    "--token",
+    default=None,
+    help="API token for authenticated actions. Not named 'main', see README.",
+)
+@click.option("--workers", default=16, type=int, help="Concurrent requests.")
+def replay(trace_files, url, speed, token, workers):
+    """Replay passwordless_api.trace_file records against a CKAN instance.
+
+    Reproduces the recorded load shape (timing and action mix) and reports
+    the latency distribution per action. Latency is measured from the
+    scheduled send time, so it includes waiting for a free worker.
+    Use a local test instance only:
+    reset key requests create users and send emails.
+    Azure AD logins are skipped, to not call the Graph API.
+
+    The token must not be named 'main': replayed passwordless_get_user calls
+    revoke the 'main' token, which would fail all later authenticated calls.
+    """
+    from requests import Session
+
+    if not (trace_files := _find_trace_files(trace_files)):
+        raise click.UsageError("No trace files found.")
+    if not (records := _load_records(trace_files)):
+        click.echo("No trace records found.")
+        return
+
+    session = Session()
+    headers = {"Authorization": token} if token else {}
+    latencies = {}
+    errors = {}
+    skipped = 0
+    lock = Lock()
+
+    def send(record, scheduled):
+        action = record["action"]
+        method, authenticated = REPLAY_ACTIONS[action]
+        try:
+            response = session.request(
+                method,
+                f"{url.rstrip('/')}/api/3/action/{action}",
+                json=_request_data(record),
+                headers=headers if authenticated else {},
+                timeout=60,
+            )
+            failed = response.status_code >= 500
+        except Exception:
+            failed = True
+        latency = (perf_counter() - scheduled) * 1000
+        with lock:
+            latencies.setdefault(action, []).append(latency)
+            errors[action] = errors.get(action, 0) + failed
+
+    first_start = records[0]["start"]
+    replay_start = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for record in records:
+            if record["action"] not in REPLAY_ACTIONS:
+                skipped += 1
+                continue
+            scheduled = replay_start + (record["start"] - first_start) / speed
+            if (delay := scheduled - perf_counter()) > 0:
+                sleep(delay)
+            executor.submit(send, record, scheduled)
+
+    click.echo(
+        f"Replayed {len(records) - skipped} requests in "
+        f"{perf_counter() - replay_start:.1f}s (skipped {skipped})"
+    )
+    click.echo(
+        f"{'action':<42}{'count':>7}{'errors':>8}"
+        f"{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (ms)"
+    )
+    for action, values in sorted(latencies.items()):
+        values.sort()
+        click.echo(
+            f"{action:<42}{len(values):>7}{errors[action]:>8}"
+            f"{_percentile(values, 50):>9.1f}{_percentile(values, 90):>9.1f}"
+            f"{_percentile(values, 99):>9.1f}{values[-1]:>9.1f}"
+        )
+
+
+def get_commands():
+    """CLI commands registered with CKAN."""
+    return [passwordless_api]
@@ -1,21 +1,26 @@
 """Logic for the API."""
 
 import logging
+from time import monotonic, sleep
 
 from ckan.common import config
 from ckan.lib import mailer
 from ckan.lib.api_token import decode as successful_jwt_decode
 from ckan.lib.navl.dictization_functions import DataError
-from ckan.lib.redis import connect_to_redis
 from ckan.logic import side_effect_free
+from ckan.model import ApiToken
 from ckan.plugins import toolkit
 
 # from ckan.types import Context, DataDict
-from requests import get as get_url
 from sqlalchemy.exc import InternalError as SQLAlchemyError
 
-from ckanext.passwordless_api import util
-from ckanext.passwordless_api.mailer import send_user_reset_key, send_welcome_email
+from ckanext.passwordless_api import refresh, replica, revocation, store, trace, util
+from ckanext.passwordless_api.mailer import (
+    combined_welcome_email,
+    send_user_reset_key,
+    send_welcome_and_reset_key,
+    send_welcome_email,
+)
 
 log = logging.getLogger(__name__)
 
@@ -34,7 +39,7 @@ def request_reset_key(
     Returns:
         dict: {message: 'success'}
     """
-    log.debug(f"Request reset key with params: {data_dict}")
+    log.debug("Request reset key with params: %s", util.Redacted(data_dict))
 
     if toolkit.c.user:
         # Don't offer the reset if already logged in
@@ -51,18 +56,18 @@ def request_reset_key(
         raise toolkit.ValidationError({"email": "invalid email"})
 
     # control attempts (exception raised on fail)
-    util.check_reset_attempts(email.encode())
+    with trace.phase("rate_limit"):
+        util.check_reset_attempts(email)
 
-    # get existing user from email
-    user = util.get_user_from_email(email)
+    # get existing user from email, or create one
+    user, created = _get_or_create_user(email)
     # log.debug(f'USER is {str(user)})
 
-    if not user:
-        # A user with this email address doesn't yet exist in CKAN, so create one.
-        new_user_email = _create_user(email)
-        log.debug(f"Created user {str(email)}")
-        user = util.get_user_from_email(new_user_email)
-        send_welcome_email(user)
+    # new users get the welcome and the login token in one email, if enabled
+    combined_email = created and combined_welcome_email()
+    if created and not combined_email:
+        with trace.phase("mail"):
+            send_welcome_email(user)
 
     if user:
         # make sure is not deleted
@@ -71,7 +76,11 @@ def request_reset_key(
                 {"user": f"User with email {email} was deleted already. Contact Admin."}
             )
         try:
-            send_user_reset_key(user)
+            with trace.phase("mail"):
+                if combined_email:
+                    send_welcome_and_reset_key(user)
+                else:
+                    send_user_reset_key(user)
 
         except mailer.MailerException as e:
             log.error(f"Could not send token link: {str(e)}")
@@ -87,6 +96,57 @@ def request_reset_key(
     return {"message": "success"}
 
 
+@trace.phase("user_lookup")
+def _get_or_create_user(email, readonly=False):
+    """Get the user with the given email, creating it on first login.
+
+    Creation holds a per-email Redis lock, so concurrent first logins (double
+    clicks, retried requests) create the user once. Other callers wait for the
+    lock, checking for the created user with an increasing delay, and reuse it.
+
+    Args:
+        email (str): Email of user.
+        readonly (bool): An existing user is not modified, may be read from
+            the database replica.
+
+    Returns:
+        tuple: (User, True if the user was created by this call)
+    """
+    if user := util.get_user_from_email(email, readonly=readonly):
+        return user, False
+
+    redis_conn = store.connect()
+    lock_key = store.user_key(email, "create_lock")
+    lock_ttl_ms = 30000
+    # Longer than the lock TTL, to take over the lock if its holder crashed
+    deadline = monotonic() + lock_ttl_ms / 1000 + 1
+    delay = 0.05
+
+    while True:
+        if lock_token := store.acquire_lock(redis_conn, lock_key, lock_ttl_ms):
+            try:
+                # May have been created while waiting for the lock
+                if user := util.get_user_from_email(email):
+                    return user, False
+                # A user with this email address doesn't yet exist in CKAN
+                new_user_email = _create_user(email)
+                log.debug("Created user %s", email)
+                return util.get_user_from_email(new_user_email), True
+            finally:
+                store.release_lock(redis_conn, lock_key, lock_token)
+
+        if monotonic() >= deadline:
+            break
+        sleep(delay)
+        delay = min(delay * 2, 1)
+        if user := util.get_user_from_email(email):
+            return user, False
+
+    raise toolkit.ValidationError(
+        {"user": "user creation already in progress, try again later"}
+    )
+
+
 def _create_user(email):
     """Create a new user and send welcome email.
 
@@ -105,6 +165,7 @@ def _create_user(email):
         user_dict = toolkit.get_action("user_create")(
             context={"ignore_auth": True}, data_dict=data_dict
         )
+        replica.mark_written()
     except SQLAlchemyError as error:
         exception_message = f"{error}"
         log.error(f"Failed to create user: {error}")
@@ -137,7 +198,7 @@ def request_api_token(
     Returns:
         dict: CKAN API token for user {'token': token_value}.
     """
-    log.debug(f"Requesting API token with params: {data_dict}")
+    log.debug("Requesting API token with params: %s", util.Redacted(data_dict))
 
     if toolkit.c.user:
         # Don't offer the reset if already logged in
@@ -154,13 +215,15 @@ def request_api_token(
     if not util.email_is_valid(email):
         raise toolkit.ValidationError({"email": "invalid email"})
     # Set user
-    if not (user := util.get_user_from_email(email)):
+    with trace.phase("user_lookup"):
+        user = util.get_user_from_email(email)
+    if not user:
         raise toolkit.ValidationError(
             {"email": "email does not correspond to a registered user"}
         )
 
     user_id = user.id
-    log.debug(f"User id: {user_id} | Key: {key}")
+    log.debug("User id: %s | Key: %s", user_id, util.Redacted(key))
 
     # Check provided key is valid
     if not user or not mailer.verify_reset_link(user, key):
@@ -168,15 +231,12 @@ def request_api_token(
 
     # Invalidate reset_key in db
     mailer.create_reset_key(user)
+    replica.mark_written()
 
     # delete attempts from Redis
-    log.debug(f"Redis: reset attempts for {email}")
-    redis_conn = connect_to_redis()
-    redis_conn.delete(email)
+    util.clear_reset_attempts(email)
 
-    expiry = int(config.get("expire_api_token.default_lifetime", 3))
-    units = int(config.get("expire_api_token.default_unit", 86400))
-    return util.renew_main_token(user_id, expiry, units)
+    return _issue_api_token(user_id)
 
 
 def request_api_token_azure_ad(
@@ -196,7 +256,10 @@ def request_api_token_azure_ad(
     Returns:
         dict: CKAN API token for user {'token': token_value}.
     """
-    log.debug(f"Requesting API token using Azure AD token params: {data_dict}")
+    log.debug(
+        "Requesting API token using Azure AD token params: %s",
+        util.Redacted(data_dict),
+    )
 
     # Check if parameters are present
     if not (email := data_dict.get("email")):
@@ -212,10 +275,13 @@ def request_api_token_azure_ad(
     # Validate Azure AD token
     try:
         log.debug("Verifying JWT token")
-        response = get_url(
-            "https://graph.microsoft.com/v1.0/me", headers={"Authorization": token}
-        ).json()
-        log.debug(f"Returned response for verification: {response}")
+        with trace.phase("azure_verify"):
+            response = (
+                util.http_session()
+                .get(util.GRAPH_ME_URL, headers={"Authorization": token})
+                .json()
+            )
+        log.debug("Returned response for verification: %s", util.Redacted(response))
 
         azure_ad_email = response.get("mail", None)
         if azure_ad_email != email:
@@ -231,23 +297,58 @@ def request_api_token_azure_ad(
         )
 
     # Check user exists, else create new user
-    if not (user := util.get_user_from_email(email)):
-        _create_user(email)
-        log.debug(f"Created user {str(email)}")
-        user = util.get_user_from_email(email)
+    user, _ = _get_or_create_user(email, readonly=True)
     # Get user id from database model
     user_id = user.id
 
     # delete attempts from Redis
-    log.debug(f"Redis: reset attempts for {email}")
-    redis_conn = connect_to_redis()
-    redis_conn.delete(email)
+    util.clear_reset_attempts(email)
+
+    return _issue_api_token(user_id)
+
+
+@trace.phase("renew_token")
+def _issue_api_token(user_id: str):
+    """Issue the API token on login, with a refresh token if enabled."""
+    if refresh.enabled():
+        return refresh.issue(user_id)
 
     expiry = int(config.get("expire_api_token.default_lifetime", 3))
     units = int(config.get("expire_api_token.default_unit", 86400))
     return util.renew_main_token(user_id, expiry, units)
 
 
+def refresh_api_token(
+    context,  #: Context,
+    data_dict,  #: DataDict,
+):
+    """Exchange a refresh token for a new API token and refresh token.
+
+    Only available if passwordless_api.refresh_tokens is enabled.
+    The refresh token is single use: reusing it revokes the login session.
+
+    Args:
+        context (Context): CKAN context, including user.
+        data_dict (DataDict):
+            - refresh_token (str, optional): Refresh token from login.
+              Read from the refresh cookie if not provided.
+
+    Returns:
+        dict: {token: api_token, refresh_token: refresh_token}
+    """
+    log.debug("Refreshing API token")
+
+    if not refresh.enabled():
+        raise toolkit.ValidationError(
+            {"refresh_token": "refresh tokens are not enabled"}
+        )
+
+    if not (refresh_token := refresh.get_refresh_token(data_dict)):
+        raise toolkit.ValidationError({"refresh_token": "missing refresh token"})
+
+    return refresh.rotate(refresh_token)
+
+
 @side_effect_free
 def revoke_api_token_no_auth(
     context,  #: Context,
@@ -262,12 +363,19 @@ def revoke_api_token_no_auth(
         context (Context): CKAN context, including user.
         data_dict (DataDict):
             - token (str, optional): Value of API token to revoke.
+            - refresh_token (str, optional): Refresh token to revoke, if
+              enabled. Read from the refresh cookie if not provided.
 
     Returns:
         dict: {message: 'success'}
     """
     log.debug("Revoking API token if present.")
 
+    refresh_revoked = False
+    if refresh.enabled() and (refresh_token := refresh.get_refresh_token(data_dict)):
+        log.debug("Revoking refresh token")
+        refresh_revoked = refresh.revoke(refresh_token)
+
     user_id = None
 
     # User cookie / logged in
@@ -287,21 +395,26 @@ def revoke_api_token_no_auth(
     else:
         # Attempt revoke provided token via POST
         if not (api_token := data_dict.get("token")):
+            if refresh_revoked:
+                return {"message": "success"}
             log.warning("Attempting to revoke API token, but none provided")
             raise toolkit.ValidationError({"token": "missing api token to revoke"})
 
-        if not successful_jwt_decode(api_token):
+        if not (token_data := successful_jwt_decode(api_token)):
             raise toolkit.ValidationError(
                 {"token": "failed to decode token, not valid"}
             )
 
         try:
+            if token_obj := ApiToken.get(token_data.get("jti")):
+                util.clear_shared_token(token_obj.user_id)
             toolkit.get_action("api_token_revoke")(
                 context={"ignore_auth": True},
                 data_dict={
                     "token": api_token,
                 },
             )
+            revocation.add(token_data.get("jti"), token_data.get("exp"))
             return {"message": "success"}
 
         except Exception as e:
@@ -325,9 +438,23 @@ def get_current_user_and_renew_api_token(
     """Return CKAN user and renew API token.
 
     Uses the user_show core action to return the user, and renews the main API token.
+    The token is not renewed if refresh tokens are enabled.
+
+    With conditional, if the request If-None-Match header matches the user
+    ETag, the user is unchanged: the token is not renewed and an empty 304
+    response is returned.
+
+    Args:
+        context (Context): CKAN context, including user.
+        data_dict (DataDict):
+            - fields (str, optional): Comma separated user fields to return,
+              e.g. 'id,name,fullname,sysadmin'. Skips the user_show dictization.
+            - conditional (bool, optional): Check the If-None-Match header.
+              Only for callers renewing the token another way, as the token
+              is not renewed if the user is unchanged.
 
     Returns:
-        dict: {user: ckan_user_obj, token: api_token}
+        dict: {user: ckan_user_obj, token: api_token, etag: user_etag}
     """
     log.debug("start function get_current_user_and_renew_api_token")
 
@@ -336,9 +463,11 @@ def get_current_user_and_renew_api_token(
         user_id = user
     elif user := context.get("auth_user_obj", None):
         if user.id == "":
-            #if user info is not available (anonymous user obj) then probably Authorization headers are not being sent correctly
+            # if user info is not available (anonymous user obj) then probably
+            # Authorization headers are not being sent correctly
             return {
-                "message": "API token is invalid or missing from Authorization header: no user name or id",
+                "message": "API token is invalid or missing from Authorization "
+                "header: no user name or id",
             }
         log.debug("User ID extracted from context auth_user_obj key")
         user_id = user.id
@@ -347,31 +476,86 @@ def get_current_user_and_renew_api_token(
             "message": "API token is invalid or missing from Authorization header",
         }
 
+    fields = util.parse_user_fields(data_dict.get("fields"))
+
     try:
-        log.info(f"Getting user details with user_id: {user_id}")
-        user = toolkit.get_action("user_show")(
-            data_dict={
-                "id": user_id,
-            },
-        )
+        log.info("Getting user details with user_id: %s", user_id)
+        with trace.phase("user_lookup"):
+            if fields:
+                user = util.get_user_fields(user_id, fields)
+            else:
+                user = toolkit.get_action("user_show")(
+                    data_dict={
+                        "id": user_id,
+                    },
+                )
+        if not user:
+            raise toolkit.ObjectNotFound("User not found")
 
     except Exception as e:
         log.error(str(e))
         log.warning(f"Could not find a user for ID: {user_id}")
         return {"message": f"could not find a user for id: {user_id}"}
 
+    etag = util.user_etag(user)
+    if toolkit.asbool(data_dict.get("conditional", False)) and _etag_matches(etag):
+        log.debug("User not modified, skipping API token renewal")
+        return {"etag": etag, "not_modified": True}
+
     if _check_token_valid(context, data_dict):
+        if refresh.enabled():
+            # Renewed with passwordless_refresh_api_token instead, so the
+            # refresh token family keeps track of the current API token
+            return {"user": user, "etag": etag}
+
         expiry = config.get("expire_api_token.default_lifetime", 3)
         units = config.get("expire_api_token.default_unit", 86400)
-        token_json = util.renew_main_token(user_id, expiry, units)
+        with trace.phase("renew_token"):
+            token_json = util.renew_main_token_shared(user_id, expiry, units)
         return {
             "user": user,
             "token": token_json.get("token"),
+            "etag": etag,
         }
 
     return {"message": "failed"}
 
 
+def _etag_matches(etag: str):
+    """Check if the request If-None-Match header contains the ETag."""
+    try:
+        return toolkit.request.if_none_match.contains_weak(etag)
+    except RuntimeError:
+        # Called outside of a request
+        return False
+
+
+@side_effect_free
+def revocation_list(
+    context,  #: Context,
+    data_dict,  #: DataDict,
+):
+    """Return revoked API tokens, for verifying tokens offline.
+
+    Services can verify the JWT signature and expiry themselves, then check
+    the jti against the Bloom filter, and only call this action with the jti
+    on a filter hit. See ckanext.passwordless_api.verifier.
+
+    Args:
+        context (Context): CKAN context, including user.
+        data_dict (DataDict):
+            - jti (str, optional): Check if the token with this jti is revoked.
+
+    Returns:
+        dict: {bloom: {size, hashes, bits}, count: int, generated_at: timestamp}
+            or {jti: jti, revoked: bool} if jti is provided.
+    """
+    if jti := data_dict.get("jti"):
+        return {"jti": jti, "revoked": revocation.is_revoked(jti)}
+
+    return revocation.get_snapshot()
+
+
 @side_effect_free
 def check_token_valid(
     context,  #: Context,
@@ -419,12 +603,8 @@ def _check_token_valid(
 
     user = None
     try:
-        log.info(f"Getting user details with user_id: {user_id}")
-        user = toolkit.get_action("user_show")(
-            data_dict={
-                "id": user_id,
-            },
-        )
+        log.info("Getting user details with user_id: %s", user_id)
+        user = util.user_exists(user_id)
 
     except Exception as e:
         log.error(str(e))
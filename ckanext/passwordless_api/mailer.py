@@ -1,61 +1,79 @@
 """Util to send emails."""
 
 import logging
+from json import loads as load_json
 
 from ckan.common import config
 from ckan.lib import mailer
 from ckan.lib.base import render
+from flask import current_app
+
+from ckanext.passwordless_api import replica
 
 log = logging.getLogger(__name__)
 
 
+def combined_welcome_email():
+    """Check if new users get the welcome and login token in one email."""
+    return bool(
+        load_json(config.get("passwordless_api.combined_welcome_email", "false"))
+    )
+
+
 def send_user_reset_key(user):
     """Send the login token email."""
     mailer.create_reset_key(user)
+    replica.mark_written()
     reset_key = user.reset_key
     body = _get_user_reset_key_body(user.as_dict(), reset_key)
     subject = f"Access token: {reset_key}"
-    log.debug(f"Sending user reset key to user: {str(user.email)}")
+    log.debug("Sending user reset key to user: %s", user.email)
     mailer.mail_user(user, subject, body)
 
 
-def _get_user_reset_key_body(user: dict, reset_key):
-    """Render the login token email."""
-    log.debug("Building user reset token email from template")
-
+def _get_user_reset_key_vars(user: dict, reset_key):
+    """Template variables for the login token email."""
     if display_name := user.get("fullname"):
         pass
     elif display_name := user.get("name"):
         pass
     else:
         display_name = user.get("email")
-    extra_vars = {
+    return {
         "site_title": config.get("ckan.site_title"),
         "site_url": config.get("ckan.site_url"),
         "display_name": display_name,
         "reset_key_bold": reset_key,
     }
+
+
+def _get_user_reset_key_template():
     # NOTE: This template is translated
-    reset_key_template = config.get(
+    return config.get(
         "passwordless_api.reset_key_template",
         "reset_key.txt",
     )
-    return render(reset_key_template, extra_vars)
+
+
+def _get_user_reset_key_body(user: dict, reset_key):
+    """Render the login token email."""
+    log.debug("Building user reset token email from template")
+
+    extra_vars = _get_user_reset_key_vars(user, reset_key)
+    return render(_get_user_reset_key_template(), extra_vars)
 
 
 def send_welcome_email(user):
     """Send the welcome email."""
     body = _get_welcome_email_body(user.as_dict())
     subject = f"Welcome to {config.get('ckan.site_title')}"
-    log.debug(f"Sending welcome email to user: {str(user.email)}")
+    log.debug("Sending welcome email to user: %s", user.email)
     mailer.mail_user(user, subject, body)
 
 
-def _get_welcome_email_body(user: dict):
-    """Render the welcome email."""
-    log.debug("Building welcome email from template")
-
-    extra_vars = {
+def _get_welcome_email_vars(user: dict):
+    """Template variables for the welcome email."""
+    return {
         "site_title": config.get("ckan.site_title"),
         "site_url": config.get("ckan.site_url"),
         "guidelines_url": config.get("passwordless_api.guidelines_url", None),
@@ -67,9 +85,74 @@ def _get_welcome_email_body(user: dict):
         "user_email": user.get("email"),
     }
 
+
+def _get_welcome_email_template():
     # NOTE: This template is translated
-    welcome_template = config.get(
+    return config.get(
         "passwordless_api.welcome_template",
         "welcome_user.txt",
     )
-    return render(welcome_template, extra_vars)
+
+
+def _get_welcome_email_body(user: dict):
+    """Render the welcome email."""
+    log.debug("Building welcome email from template")
+
+    extra_vars = _get_welcome_email_vars(user)
+    return render(_get_welcome_email_template(), extra_vars)
+
+
+def send_welcome_and_reset_key(user):
+    """Send the welcome email and the login token as a single email.
+
+    Saves an SMTP round trip on the first login of new users.
+    """
+    mailer.create_reset_key(user)
+    replica.mark_written()
+    reset_key = user.reset_key
+    body = _get_welcome_and_reset_key_body(user.as_dict(), reset_key)
+    subject = f"Welcome to {config.get('ckan.site_title')}, access token: {reset_key}"
+    log.debug("Sending welcome email with reset key to user: %s", user.email)
+    mailer.mail_user(user, subject, body)
+
+
+def _get_welcome_and_reset_key_body(user: dict, reset_key):
+    """Render the welcome email, including the login token.
+
+    Extends the welcome template, adding the 'token' block of the reset key
+    template to its 'content' block.
+    """
+    log.debug("Building welcome email with reset key from template")
+
+    extra_vars = {
+        **_get_welcome_email_vars(user),
+        **_get_user_reset_key_vars(user, reset_key),
+    }
+
+    jinja_env = current_app.jinja_env
+    reset_key_template = _get_user_reset_key_template()
+    template = jinja_env.get_template(reset_key_template)
+    if token_block := template.blocks.get("token"):
+        reset_key_token = "".join(token_block(template.new_context(extra_vars)))
+    else:
+        log.warning(
+            "No 'token' block in %s, including the whole email", reset_key_template
+        )
+        reset_key_token = render(reset_key_template, extra_vars)
+
+    welcome_template = _get_welcome_email_template()
+    if "content" not in jinja_env.get_template(welcome_template).blocks:
+        log.warning(
+            "No 'content' block in %s, using the default welcome template",
+            welcome_template,
+        )
+        welcome_template = "welcome_user.txt"
+
+    extra_vars.update(
+        {"welcome_template": welcome_template, "reset_key_token": reset_key_token}
+    )
+    welcome_reset_key_template = config.get(
+        "passwordless_api.welcome_reset_key_template",
+        "welcome_reset_key.txt",
+    )
+    return render(welcome_reset_key_template, extra_vars)
@@ -1,21 +1,90 @@
 """Init plugin with CKAN interfaces."""
 
+import ast
 import logging
+import os
+from functools import lru_cache, partial
+from importlib import import_module
 from json import loads as load_json
 
 from ckan.plugins import SingletonPlugin, implements, interfaces, toolkit
 
-from ckanext.passwordless_api.logic import (
-    check_token_valid,
-    get_current_user_and_renew_api_token,
-    request_api_token,
-    request_api_token_azure_ad,
-    request_reset_key,
-    revoke_api_token_no_auth,
-)
-
 log = logging.getLogger(__name__)
 
+# Action name -> (function name in logic.py, side effect free)
+# The logic module and its dependencies (requests, dateutil, mailer, redis)
+# are only imported when an action is first called, not at plugin load.
+ACTIONS = {
+    "passwordless_request_reset_key": ("request_reset_key", False),
+    "passwordless_request_api_token": ("request_api_token", False),
+    "passwordless_request_api_token_azure_ad": ("request_api_token_azure_ad", False),
+    "passwordless_refresh_api_token": ("refresh_api_token", False),
+    "passwordless_revoke_api_token": ("revoke_api_token_no_auth", True),
+    "passwordless_get_user": ("get_current_user_and_renew_api_token", True),
+    "passwordless_introspect": ("check_token_valid", True),
+    "passwordless_revocation_list": ("revocation_list", True),
+}
+
+# Redis connection modes, see store.connect
+# Defined here to validate the config without importing store and redis.
+REDIS_MODES = ("standalone", "cluster", "sentinel")
+
+
+@lru_cache(maxsize=None)
+def _action_docs():
+    """Docstrings of the logic.py functions, read without importing it.
+
+    CKAN returns the action docstrings from help_show and in API errors.
+    """
+    path = os.path.join(os.path.dirname(__file__), "logic.py")
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    return {
+        node.name: ast.get_docstring(node)
+        for node in tree.body
+        if isinstance(node, ast.FunctionDef)
+    }
+
+
+def _lazy_action(action_name: str, function_name: str, side_effect_free: bool):
+    """Return an action that resolves the logic function on first call.
+
+    Calls go through trace.call_action, which records traces if enabled,
+    and profiling.call_action, which profiles sampled calls.
+    """
+
+    def action(context, data_dict):
+        function = getattr(
+            import_module("ckanext.passwordless_api.logic"), function_name
+        )
+        profiling = import_module("ckanext.passwordless_api.profiling")
+        return import_module("ckanext.passwordless_api.trace").call_action(
+            action_name,
+            partial(profiling.call_action, action_name, function),
+            context,
+            data_dict,
+        )
+
+    action.__name__ = function_name
+    action.__qualname__ = function_name
+    action.__doc__ = _action_docs().get(function_name)
+    if side_effect_free:
+        # Must be known before the import, CKAN checks it to allow GET
+        action.side_effect_free = True
+    return action
+
+
+def _action_result(response):
+    """Get the result of an action API response, or an empty dict."""
+    try:
+        # also set direct_passthrough = False to avoid warnings
+        response.direct_passthrough = False
+        return load_json(response.data).get("result") or {}
+    except Exception:
+        # Required to bypass errors and continue loading
+        # Do not pollute logs
+        return {}
+
 
 class PasswordlessAPIPlugin(SingletonPlugin):
     """PasswordlessPlugin.
@@ -26,12 +95,43 @@ class PasswordlessAPIPlugin(SingletonPlugin):
     implements(interfaces.IConfigurer)
     implements(interfaces.IActions)
     implements(interfaces.IMiddleware, inherit=True)
+    implements(interfaces.IClick)
 
     # IConfigurer
     def update_config(self, config):
         """Update CKAN with plugin specific config."""
         toolkit.add_template_directory(config, "templates")
 
+        # Check Redis config
+        redis_mode = config.get("passwordless_api.redis_mode", "standalone")
+        if redis_mode not in REDIS_MODES:
+            err_str = (
+                "passwordless_api.redis_mode must be one of: "
+                f"{', '.join(REDIS_MODES)}"
+            )
+            log.error(err_str)
+            raise toolkit.ObjectNotFound(err_str)
+        if redis_mode == "sentinel" and not config.get(
+            "passwordless_api.redis_sentinels", None
+        ):
+            err_str = (
+                "passwordless_api.redis_sentinels setting is required if "
+                "redis_mode is sentinel"
+            )
+            log.error(err_str)
+            raise toolkit.ObjectNotFound(err_str)
+
+        # Check trace config
+        if config.get("passwordless_api.trace_file", None) and not config.get(
+            "passwordless_api.trace_salt", None
+        ):
+            err_str = (
+                "passwordless_api.trace_salt setting is required if "
+                "passwordless_api.trace_file is set"
+            )
+            log.error(err_str)
+            raise toolkit.ObjectNotFound(err_str)
+
         # Check cookie config
         if cookie_name := config.get("passwordless_api.cookie_name", None):
             log.debug("ckanext-passwordless_api cookies enabled")
@@ -60,21 +160,72 @@ class PasswordlessAPIPlugin(SingletonPlugin):
             token_units = int(config.get("expire_api_token.default_unit", 86400))
             self.cookie_expiry = token_expiry * token_units
 
+            # Refresh token cookie, if enabled
+            self.refresh_cookie_name = None
+            if bool(load_json(config.get("passwordless_api.refresh_tokens", "false"))):
+                self.cookie_expiry = int(
+                    config.get("passwordless_api.access_token_lifetime", 900)
+                )
+                self.refresh_cookie_name = config.get(
+                    "passwordless_api.refresh_cookie_name", f"{cookie_name}_refresh"
+                )
+                self.refresh_cookie_path = config.get(
+                    "passwordless_api.refresh_cookie_path", self.cookie_path
+                )
+                self.refresh_cookie_expiry = int(
+                    config.get("passwordless_api.refresh_token_lifetime", 2592000)
+                )
+
     # IActions
     def get_actions(self):
         """Actions to be accessible via the API."""
         return {
-            "passwordless_request_reset_key": request_reset_key,
-            "passwordless_request_api_token": request_api_token,
-            "passwordless_request_api_token_azure_ad": request_api_token_azure_ad,
-            "passwordless_revoke_api_token": revoke_api_token_no_auth,
-            "passwordless_get_user": get_current_user_and_renew_api_token,
-            "passwordless_introspect": check_token_valid,
+            name: _lazy_action(name, function_name, side_effect_free)
+            for name, (function_name, side_effect_free) in ACTIONS.items()
         }
 
+    # IClick
+    def get_commands(self):
+        """CLI commands, e.g. to replay action traces."""
+        return import_module("ckanext.passwordless_api.cli").get_commands()
+
     # IMiddleware
     def make_middleware(self, app, config):
         """Create middleware for the Flask app."""
+        if bool(load_json(config.get("passwordless_api.warmup", "false"))):
+            import_module("ckanext.passwordless_api.warmup").schedule(app)
+
+        @app.before_request
+        @app.teardown_request
+        def reset_replica_reads(*args):
+            """Read from the replica again, and release its connection."""
+            if config.get("passwordless_api.replica_url", None):
+                import_module("ckanext.passwordless_api.replica").reset()
+
+        @app.after_request
+        def no_store_api_tokens(response):
+            """Never cache responses with an API token, e.g. in the browser."""
+            if "/passwordless_" not in toolkit.request.path:
+                return response
+
+            if _action_result(response).get("token"):
+                response.headers["Cache-Control"] = "no-store"
+            return response
+
+        @app.after_request
+        def add_user_etag(response):
+            """Set the passwordless_get_user ETag, or 304 if not modified."""
+            if not toolkit.request.path.endswith("/passwordless_get_user"):
+                return response
+            result = _action_result(response)
+            if not (etag := result.get("etag")):
+                return response
+
+            response.set_etag(etag)
+            if result.get("not_modified"):
+                response.status_code = 304
+                response.set_data(b"")
+            return response
 
         @app.after_request
         def add_api_token_cookie(response):
@@ -82,24 +233,21 @@ class PasswordlessAPIPlugin(SingletonPlugin):
             if not config.get("passwordless_api.cookie_name", None):
                 return response
 
-            try:
-                # token already present in both renew_api_token and get_user
-                # simply return response with token
-                # also set direct_passthrough = False to avoid warnings
-                response.direct_passthrough = False
-                if not (token := load_json(response.data).get("result").get("token")):
-                    return response
-            except Exception:
-                # Required to bypass errors and continue loading
-                # Do not pollute logs
+            # token already present in both renew_api_token and get_user
+            # simply return response with token
+            result = _action_result(response)
+            if not (token := result.get("token")):
                 return response
 
             log.debug(
-                "Adding cookie to response with vars: "
-                f"key={self.cookie_name} | value={token} | "
-                f"max_age={self.cookie_expiry} | domain={self.cookie_domain} | "
-                f"secure={self.cookie_secure} | httponly={self.cookie_http_only} | "
-                f"samesite={self.cookie_samesite}"
+                "Adding cookie to response with vars: key=%s | value=*** | "
+                "max_age=%s | domain=%s | secure=%s | httponly=%s | samesite=%s",
+                self.cookie_name,
+                self.cookie_expiry,
+                self.cookie_domain,
+                self.cookie_secure,
+                self.cookie_http_only,
+                self.cookie_samesite,
             )
             response.set_cookie(
                 key=self.cookie_name,
@@ -111,6 +259,21 @@ class PasswordlessAPIPlugin(SingletonPlugin):
                 samesite=self.cookie_samesite,
                 path=self.cookie_path,
             )
+
+            if self.refresh_cookie_name and (
+                refresh_token := result.get("refresh_token")
+            ):
+                log.debug("Adding refresh token cookie %s", self.refresh_cookie_name)
+                response.set_cookie(
+                    key=self.refresh_cookie_name,
+                    value=refresh_token,
+                    max_age=self.refresh_cookie_expiry,
+                    domain=self.cookie_domain,
+                    secure=self.cookie_secure,
+                    httponly=self.cookie_http_only,
+                    samesite=self.cookie_samesite,
+                    path=self.refresh_cookie_path,
+                )
             return response
 
         return app
@@ -0,0 +1,101 @@
+"""Sampled profiling of passwordless actions.
+
+Profiles 1 in passwordless_api.profile_sample_rate action calls, and calls
+sending the passwordless_api.profile_header header with the configured
+passwordless_api.profile_secret. Each profile is written as a .pstats file
+to passwordless_api.profile_dir, to be viewed with e.g. snakeviz, or turned
+into a flame graph with flameprof.
+"""
+
+import logging
+import os
+from cProfile import Profile
+from datetime import datetime
+from hmac import compare_digest
+from random import randrange
+from tempfile import gettempdir
+from uuid import uuid4
+
+from ckan.common import config
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+
+def _requested_by_header():
+    """Check if the request has the profiling header, with the secret."""
+    if not (secret := config.get("passwordless_api.profile_secret", None)):
+        return False
+
+    header = config.get("passwordless_api.profile_header", "X-Passwordless-Profile")
+    try:
+        value = toolkit.request.headers.get(header)
+    except RuntimeError:
+        # Called outside of a request
+        return False
+    if value is None:
+        return False
+
+    try:
+        # As bytes, compare_digest does not support non-ASCII strings
+        return compare_digest(value.encode(), secret.encode())
+    except UnicodeEncodeError:
+        return False
+
+
+def should_profile():
+    """Check if the current action call should be profiled."""
+    sample_rate = int(config.get("passwordless_api.profile_sample_rate", 0))
+    if sample_rate > 0 and randrange(sample_rate) == 0:
+        return True
+    return _requested_by_header()
+
+
+def _write_profile(profile: Profile, action_name: str):
+    """Write the profile stats to the profile directory."""
+    profile_dir = config.get(
+        "passwordless_api.profile_dir",
+        os.path.join(gettempdir(), "passwordless_api_profiles"),
+    )
+    os.makedirs(profile_dir, exist_ok=True)
+
+    timestamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+    path = os.path.join(
+        profile_dir, f"{action_name}-{timestamp}-{uuid4().hex[:8]}.pstats"
+    )
+    profile.dump_stats(path)
+    log.info("Wrote profile for %s to %s", action_name, path)
+
+    _prune_profiles(profile_dir)
+
+
+def _prune_profiles(profile_dir: str):
+    """Delete the oldest profiles above passwordless_api.profile_max_files."""
+    max_files = int(config.get("passwordless_api.profile_max_files", 100))
+    with os.scandir(profile_dir) as entries:
+        profiles = sorted(
+            (entry for entry in entries if entry.name.endswith(".pstats")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+
+    for entry in profiles[: max(len(profiles) - max_files, 0)]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            # Pruned by another worker
+            pass
+
+
+def call_action(action_name: str, function, context, data_dict):
+    """Call an action function, profiling it if sampled."""
+    if not should_profile():
+        return function(context, data_dict)
+
+    profile = Profile()
+    try:
+        return profile.runcall(function, context, data_dict)
+    finally:
+        try:
+            _write_profile(profile, action_name)
+        except OSError as e:
+            log.warning("Could not write profile for %s: %s", action_name, e)
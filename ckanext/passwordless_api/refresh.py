@@ -0,0 +1,225 @@
+"""Refresh tokens, to renew short lived API tokens.
+
+Opt-in with passwordless_api.refresh_tokens. Login then returns a short lived
+API (access) token and a long lived refresh token. Refresh tokens are stored
+hashed in Redis, one record per login (token family), and rotated on each use.
+Reusing an already rotated refresh token revokes the whole family.
+"""
+
+import logging
+from datetime import datetime, timezone
+from hashlib import sha256
+from json import loads as load_json
+from secrets import token_urlsafe
+from uuid import uuid4
+
+from ckan.common import config
+from ckan.lib.api_token import decode as jwt_decode
+from ckan.plugins import toolkit
+
+from ckanext.passwordless_api import revocation, store, util
+
+log = logging.getLogger(__name__)
+
+# Atomically swap the current secret hash, so concurrent exchanges of the
+# same refresh token can only succeed once. Returns the status, and the
+# family user_id and access_jti if ok.
+ROTATE_SCRIPT = """
+local current = redis.call('hget', KEYS[1], 'secret_hash')
+if not current then
+    return {'missing'}
+end
+if current == ARGV[1] then
+    redis.call('hset', KEYS[1], 'secret_hash', ARGV[2])
+    redis.call('sadd', KEYS[2], ARGV[1])
+    redis.call('expire', KEYS[2], ARGV[3])
+    local family = redis.call('hmget', KEYS[1], 'user_id', 'access_jti')
+    return {'ok', family[1] or '', family[2] or ''}
+end
+if redis.call('sismember', KEYS[2], ARGV[1]) == 1 then
+    return {'reused'}
+end
+return {'invalid'}
+"""
+
+# Set the family access_jti, only if the family was not revoked meanwhile
+SET_ACCESS_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('hset', KEYS[1], 'access_jti', ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+def enabled():
+    """Check if refresh tokens are enabled."""
+    return bool(load_json(config.get("passwordless_api.refresh_tokens", "false")))
+
+
+def access_token_lifetime():
+    """API token lifetime in seconds, if refresh tokens are enabled."""
+    return int(config.get("passwordless_api.access_token_lifetime", 900))
+
+
+def refresh_token_lifetime():
+    """Refresh token lifetime in seconds."""
+    return int(config.get("passwordless_api.refresh_token_lifetime", 2592000))
+
+
+def refresh_cookie_name():
+    """Cookie name for the refresh token, if cookies are enabled."""
+    if not (cookie_name := config.get("passwordless_api.cookie_name", None)):
+        return None
+    return config.get("passwordless_api.refresh_cookie_name", f"{cookie_name}_refresh")
+
+
+def get_refresh_token(data_dict):
+    """Get the refresh token from the request data, or the refresh cookie."""
+    if refresh_token := data_dict.get("refresh_token"):
+        return refresh_token
+    if cookie_name := refresh_cookie_name():
+        try:
+            return toolkit.request.cookies.get(cookie_name)
+        except RuntimeError:
+            # Called outside of a request
+            pass
+    return None
+
+
+def _hash(secret: str):
+    return sha256(secret.encode()).hexdigest()
+
+
+def _keys(family: str):
+    """Keys for a token family record, and its used secret hashes."""
+    return store.key(f"refresh:{family}"), store.key(f"refresh:{family}", "used")
+
+
+def _split(refresh_token: str):
+    """Split a refresh token into family ID and secret."""
+    family, _, secret = (refresh_token or "").partition(".")
+    if not family or not secret:
+        raise toolkit.ValidationError({"refresh_token": "invalid refresh token"})
+    return family, secret
+
+
+def _create_access_token(user_id: str):
+    """Create a short lived API token, named 'main' like in renew_main_token.
+
+    Returns:
+        tuple: (token, jti)
+    """
+    token = toolkit.get_action("api_token_create")(
+        context={"ignore_auth": True},
+        data_dict={
+            "user": user_id,
+            "name": "main",
+            "expires_in": access_token_lifetime(),
+            "unit": 1,
+        },
+    )["token"]
+    return token, jwt_decode(token)["jti"]
+
+
+def _revoke_access_token(jti: str):
+    """Revoke an API token by jti, ignoring already removed tokens."""
+    try:
+        toolkit.get_action("api_token_revoke")(
+            context={"ignore_auth": True}, data_dict={"jti": jti}
+        )
+    except Exception as e:
+        log.warning("Could not revoke API token %s: %s", jti, e)
+    # API tokens are short lived with refresh tokens enabled
+    revocation.add(
+        jti, datetime.now(timezone.utc).timestamp() + access_token_lifetime()
+    )
+
+
+def issue(user_id: str):
+    """Issue an API token and a new refresh token family on login.
+
+    Replaces existing 'main' API tokens, as in renew_main_token.
+
+    Returns:
+        dict: {token: api_token, refresh_token: refresh_token}
+    """
+    api_token = util.renew_main_token(user_id, access_token_lifetime(), 1)
+    if not api_token:
+        return None
+
+    family = uuid4().hex
+    secret = token_urlsafe(32)
+    family_key, _ = _keys(family)
+
+    redis_conn = store.connect()
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.hset(
+        family_key,
+        mapping={
+            "user_id": user_id,
+            "secret_hash": _hash(secret),
+            "access_jti": jwt_decode(api_token["token"])["jti"],
+        },
+    )
+    pipe.expire(family_key, refresh_token_lifetime())
+    pipe.execute()
+
+    log.debug("Issued refresh token family %s for user id: %s", family, user_id)
+    return {"token": api_token["token"], "refresh_token": f"{family}.{secret}"}
+
+
+def rotate(refresh_token: str):
+    """Exchange a refresh token for a new API token and refresh token.
+
+    Only the previous API token of the family is revoked (by jti), no
+    api_token_list lookup is needed.
+
+    Returns:
+        dict: {token: api_token, refresh_token: refresh_token}
+    """
+    family, secret = _split(refresh_token)
+    family_key, used_key = _keys(family)
+    new_secret = token_urlsafe(32)
+
+    redis_conn = store.connect()
+    status, *family_values = (
+        value.decode() if isinstance(value, bytes) else value
+        for value in redis_conn.register_script(ROTATE_SCRIPT)(
+            keys=[family_key, used_key],
+            args=[_hash(secret), _hash(new_secret), refresh_token_lifetime()],
+        )
+    )
+
+    if status == "reused":
+        log.warning("Refresh token reuse detected, revoking family %s", family)
+        revoke(refresh_token)
+        raise toolkit.NotAuthorized("refresh token already used, login again")
+    if status != "ok" or not (user_id := family_values[0]):
+        raise toolkit.NotAuthorized("refresh token is invalid or expired")
+
+    if access_jti := family_values[1]:
+        _revoke_access_token(access_jti)
+
+    token, jti = _create_access_token(user_id)
+    if not redis_conn.register_script(SET_ACCESS_SCRIPT)(keys=[family_key], args=[jti]):
+        # Family revoked during the exchange, e.g. on logout
+        _revoke_access_token(jti)
+        raise toolkit.NotAuthorized("refresh token is invalid or expired")
+
+    log.debug("Rotated refresh token family %s for user id: %s", family, user_id)
+    return {"token": token, "refresh_token": f"{family}.{new_secret}"}
+
+
+def revoke(refresh_token: str):
+    """Revoke a refresh token family and its current API token."""
+    try:
+        family, _ = _split(refresh_token)
+    except toolkit.ValidationError:
+        return False
+
+    family_key, used_key = _keys(family)
+    redis_conn = store.connect()
+    if access_jti := redis_conn.hget(family_key, "access_jti"):
+        _revoke_access_token(access_jti.decode())
+    return bool(redis_conn.delete(family_key, used_key))
@@ -0,0 +1,58 @@
+"""Optional database read replica, for the plugin's read-only lookups.
+
+Enabled with passwordless_api.replica_url. Once the plugin has written to the
+primary database during a request (e.g. created a user or an API token),
+reads go to the primary for the rest of the request, to read its own writes.
+"""
+
+import logging
+from contextvars import ContextVar
+
+from ckan.common import config
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+log = logging.getLogger(__name__)
+
+# Set once the plugin has written to the primary, in the current request
+_written = ContextVar("passwordless_api_written", default=False)
+
+# Replica session, created on first use
+_session = None
+
+
+def _replica_session():
+    global _session
+
+    if _session is None:
+        if not (url := config.get("passwordless_api.replica_url", None)):
+            return None
+        log.debug("Using database read replica for passwordless lookups")
+        _session = scoped_session(
+            sessionmaker(bind=create_engine(url, pool_pre_ping=True))
+        )
+    return _session
+
+
+def read_session():
+    """Get the replica session for a read-only lookup.
+
+    Returns:
+        scoped_session: Replica session, or None if no replica is configured,
+            or the plugin already wrote to the primary in this request.
+    """
+    if _written.get():
+        return None
+    return _replica_session()
+
+
+def mark_written():
+    """Route reads to the primary for the rest of the request."""
+    _written.set(True)
+
+
+def reset():
+    """Reset the read routing and release the replica session, per request."""
+    _written.set(False)
+    if _session is not None:
+        _session.remove()
@@ -0,0 +1,122 @@
+"""Revoked API tokens, published for offline token verification.
+
+Revoked token jtis are kept in a Redis sorted set, scored by the token expiry,
+until the token would have expired anyway. A Bloom filter snapshot of the set
+is rebuilt periodically, for services using verifier.TokenVerifier.
+"""
+
+import logging
+from datetime import datetime, timezone
+from json import dumps as dump_json
+from json import loads as load_json
+
+from ckan.common import config
+from dateutil import parser as dateparser
+
+from ckanext.passwordless_api import store
+from ckanext.passwordless_api.verifier import BloomFilter
+
+log = logging.getLogger(__name__)
+
+
+def _revoked_key():
+    return store.key("revoked", "jti")
+
+
+def _bloom_key():
+    return store.key("revoked", "bloom")
+
+
+def default_expiry():
+    """Expiry timestamp for revoked tokens with an unknown expiry.
+
+    Uses the default API token lifetime, the longest a token is issued for.
+    """
+    lifetime = int(config.get("expire_api_token.default_lifetime", 3))
+    units = int(config.get("expire_api_token.default_unit", 86400))
+    return datetime.now(timezone.utc).timestamp() + lifetime * units
+
+
+def token_expiry(token: dict):
+    """Expiry timestamp of an api_token_list token dict.
+
+    Requires the token plugin_extras, set by the expire_api_token plugin.
+    """
+    try:
+        expiry = dateparser.parse(token["plugin_extras"]["expire_api_token"]["exp"])
+        return expiry.replace(tzinfo=timezone.utc).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return default_expiry()
+
+
+def add(jti: str, expires_at: float = None):
+    """Record a revoked token jti, until the token expiry timestamp."""
+    now = datetime.now(timezone.utc).timestamp()
+    if expires_at is None:
+        expires_at = default_expiry()
+    if expires_at <= now:
+        return
+
+    log.debug("Recording revoked API token %s", jti)
+    pipe = store.connect().pipeline(transaction=False)
+    pipe.zadd(_revoked_key(), {jti: expires_at})
+    # Drop tokens that have expired since
+    pipe.zremrangebyscore(_revoked_key(), "-inf", now)
+    pipe.execute()
+
+
+def is_revoked(jti: str):
+    """Check if a token jti has been revoked (and not yet expired)."""
+    expires_at = store.connect().zscore(_revoked_key(), jti)
+    return bool(expires_at and expires_at > datetime.now(timezone.utc).timestamp())
+
+
+def build_snapshot():
+    """Build a Bloom filter of the currently revoked token jtis.
+
+    Returns:
+        dict: {bloom: bloom_filter_dict, count: int, generated_at: timestamp}
+    """
+    now = datetime.now(timezone.utc).timestamp()
+    jtis = store.connect().zrangebyscore(_revoked_key(), now, "+inf")
+
+    error_rate = float(
+        config.get("passwordless_api.revocation_bloom_error_rate", 0.001)
+    )
+    # Room to grow until the next rebuild
+    bloom = BloomFilter.for_capacity(max(2 * len(jtis), 1024), error_rate)
+    for jti in jtis:
+        bloom.add(jti.decode())
+
+    return {"bloom": bloom.to_dict(), "count": len(jtis), "generated_at": now}
+
+
+def get_snapshot():
+    """Get the Bloom filter snapshot, rebuilt if older than the interval.
+
+    Returns:
+        dict: {bloom: bloom_filter_dict, count: int, generated_at: timestamp}
+    """
+    interval = int(config.get("passwordless_api.revocation_bloom_interval", 60))
+    now = datetime.now(timezone.utc).timestamp()
+
+    redis_conn = store.connect()
+    if cached := redis_conn.get(_bloom_key()):
+        snapshot = load_json(cached)
+        if now - snapshot["generated_at"] < interval:
+            return snapshot
+
+    # Only one worker rebuilds, others return the outdated snapshot meanwhile
+    lock_key = store.key("revoked", "bloom_lock")
+    if not (lock_token := store.acquire_lock(redis_conn, lock_key, 10000)):
+        if cached:
+            return snapshot
+        return build_snapshot()
+
+    try:
+        snapshot = build_snapshot()
+        redis_conn.set(_bloom_key(), dump_json(snapshot))
+        log.debug("Rebuilt revoked tokens Bloom filter: %s jtis", snapshot["count"])
+        return snapshot
+    finally:
+        store.release_lock(redis_conn, lock_key, lock_token)
@@ -0,0 +1,122 @@
+"""Redis connection and key layout for the plugin state.
+
+Keys are namespaced with a prefix and a hash tag, e.g.
+'passwordless:{user:name@example.com}:attempts'. All keys for one email share
+the hash tag, so they map to the same Redis Cluster slot and can be used
+together in a pipeline or a script.
+"""
+
+import logging
+from urllib.parse import urlsplit
+from uuid import uuid4
+
+from ckan.common import config
+from ckan.lib.redis import connect_to_redis
+
+log = logging.getLogger(__name__)
+
+# Delete a lock only if still held by the caller (token matches)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Cluster / Sentinel client. Standalone uses the CKAN core connection pool.
+_client = None
+
+
+def connect():
+    """Connect to Redis, as configured by passwordless_api.redis_mode.
+
+    Returns:
+        redis.Redis | redis.cluster.RedisCluster: A lazy Redis connection.
+    """
+    global _client
+
+    mode = config.get("passwordless_api.redis_mode", "standalone")
+    if mode == "standalone":
+        return connect_to_redis()
+
+    if _client is None:
+        if mode == "cluster":
+            from redis.cluster import RedisCluster
+
+            url = config.get("passwordless_api.redis_url") or config.get(
+                "ckan.redis.url"
+            )
+            # Not the full URL, it may contain the password
+            parsed_url = urlsplit(url)
+            log.debug(
+                "Using Redis Cluster at %s:%s", parsed_url.hostname, parsed_url.port
+            )
+            _client = RedisCluster.from_url(url)
+
+        elif mode == "sentinel":
+            from redis.sentinel import Sentinel
+
+            sentinels = [
+                (host, int(port))
+                for host, port in (
+                    sentinel.rsplit(":", 1)
+                    for sentinel in config.get(
+                        "passwordless_api.redis_sentinels", ""
+                    ).split()
+                )
+            ]
+            service = config.get("passwordless_api.redis_sentinel_service", "mymaster")
+            log.debug("Using Redis Sentinel service %s at %s", service, sentinels)
+            _client = Sentinel(sentinels).master_for(
+                service,
+                db=int(config.get("passwordless_api.redis_db", 0)),
+                password=config.get("passwordless_api.redis_password", None),
+            )
+
+        else:
+            raise ValueError(f"Unknown passwordless_api.redis_mode: {mode}")
+
+    return _client
+
+
+def key(tag: str, *parts: str):
+    """Build a namespaced key, hash tagged on the given tag.
+
+    Args:
+        tag (str): Keys with the same tag are stored in the same cluster slot.
+        parts (str): Remaining key parts.
+
+    Returns:
+        str: The Redis key.
+    """
+    prefix = config.get("passwordless_api.redis_key_prefix", "passwordless")
+    return ":".join([prefix, f"{{{tag}}}", *parts])
+
+
+def user_key(email: str, *parts: str):
+    """Build a key for state belonging to an email address."""
+    if isinstance(email, bytes):
+        email = email.decode()
+    return key(f"user:{email.lower()}", *parts)
+
+
+def acquire_lock(redis_conn, lock_key: str, ttl_ms: int):
+    """Try to acquire a short lived lock, without waiting.
+
+    Args:
+        redis_conn (redis.Redis): Redis connection.
+        lock_key (str): Key for the lock.
+        ttl_ms (int): Lock expiry in milliseconds, in case it is never released.
+
+    Returns:
+        str: Lock token to release the lock with, or None if already locked.
+    """
+    lock_token = uuid4().hex
+    if redis_conn.set(lock_key, lock_token, nx=True, px=ttl_ms):
+        return lock_token
+    return None
+
+
+def release_lock(redis_conn, lock_key: str, lock_token: str):
+    """Release a lock, if it is still held with the given token."""
+    redis_conn.register_script(RELEASE_LOCK_SCRIPT)(keys=[lock_key], args=[lock_token])
@@ -0,0 +1,96 @@
+"""Tests for the replay command in cli.py."""
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from click.testing import CliRunner
+
+from ckanext.passwordless_api import cli
+
+# Response time of the fake CKAN instance, in seconds
+RESPONSE_TIME = 0.1
+
+
+class _SlowHandler(BaseHTTPRequestHandler):
+    def do_POST(self):  # noqa: N802
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(RESPONSE_TIME)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'{"success": true}')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def ckan_url():
+    """URL of a fake CKAN instance, answering in RESPONSE_TIME."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SlowHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    """A burst of reset key requests, recorded at the same time."""
+    path = tmp_path / "trace.jsonl"
+    records = [
+        {"action": "passwordless_request_reset_key", "start": 1000.0, "email": "a"},
+        {"action": "passwordless_request_reset_key", "start": 1000.0, "email": "b"},
+        {"action": "passwordless_request_reset_key", "start": 1000.0, "email": "c"},
+        {"action": "passwordless_request_api_token_azure_ad", "start": 1000.1},
+    ]
+    path.write_text("".join(f"{json.dumps(record)}\n" for record in records))
+    return str(path)
+
+
+def _max_latency(output, action):
+    for line in output.splitlines():
+        if line.startswith(action):
+            return float(line.split()[-1])
+    raise AssertionError(f"{action} missing from output:\n{output}")
+
+
+def test_replay_includes_queueing_delay(ckan_url, trace_file):
+    """Requests waiting for a free worker count towards their latency."""
+    result = CliRunner().invoke(
+        cli.replay, [trace_file, "--url", ckan_url, "--workers", "1"]
+    )
+
+    assert result.exit_code == 0, result.output
+    assert "Replayed 3 requests" in result.output
+    assert "skipped 1" in result.output
+    # The last request waited for the two before it
+    max_latency = _max_latency(result.output, "passwordless_request_reset_key")
+    assert max_latency >= 3 * RESPONSE_TIME * 1000 * 0.9
+
+
+def test_find_process_trace_files(tmp_path):
+    """The configured trace file expands to the files of all processes."""
+    for name in ("trace.111.jsonl", "trace.222.jsonl", "trace.222.jsonl.1"):
+        (tmp_path / name).write_text("")
+    (tmp_path / "other.jsonl").write_text("")
+
+    trace_files = cli._find_trace_files([str(tmp_path / "trace.jsonl")])
+
+    assert [os.path.basename(path) for path in trace_files] == [
+        "trace.111.jsonl",
+        "trace.222.jsonl",
+        "trace.222.jsonl.1",
+    ]
+
+
+def test_replay_speed_must_be_positive(trace_file):
+    """A zero speed is rejected."""
+    result = CliRunner().invoke(cli.replay, [trace_file, "--speed", "0"])
+
+    assert result.exit_code == 2
+    assert "--speed" in result.output
@@ -0,0 +1,53 @@
+"""Tests for the passwordless_get_user ETag and token renewal."""
+
+import pytest
+from ckan.tests import factories
+
+URL = "/api/3/action/passwordless_get_user"
+
+
+@pytest.fixture
+def auth_headers():
+    """Authorization header for a new user."""
+    user = factories.User()
+    return {"Authorization": factories.APIToken(user=user["name"])["token"]}
+
+
+def _get_user(app, headers, **params):
+    return app.get(URL, headers=headers, query_string={"fields": "id,name", **params})
+
+
+@pytest.mark.ckan_config("ckan.plugins", "passwordless_api expire_api_token")
+@pytest.mark.ckan_config("passwordless_api.renew_coalesce_seconds", "0")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_redis")
+def test_renews_token_with_if_none_match(app, auth_headers):
+    """Without conditional, If-None-Match (e.g. from a browser) is ignored."""
+    first = _get_user(app, auth_headers)
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "no-store"
+
+    second = _get_user(app, {**auth_headers, "If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 200
+    assert second.headers["Cache-Control"] == "no-store"
+    assert second.json["result"]["token"] != first.json["result"]["token"]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "passwordless_api expire_api_token")
+@pytest.mark.ckan_config("passwordless_api.renew_coalesce_seconds", "0")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_redis")
+def test_not_modified_if_conditional(app, auth_headers):
+    """With conditional, an unchanged user returns 304 without a token."""
+    first = _get_user(app, auth_headers)
+    etag = first.headers["ETag"]
+
+    response = _get_user(
+        app, {**auth_headers, "If-None-Match": etag}, conditional="true"
+    )
+    assert response.status_code == 304
+    assert response.data == b""
+
+    response = _get_user(
+        app, {**auth_headers, "If-None-Match": '"other"'}, conditional="true"
+    )
+    assert response.status_code == 200
+    assert response.json["result"]["token"]
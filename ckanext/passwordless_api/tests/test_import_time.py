@@ -0,0 +1,68 @@
+"""Import time benchmark for plugin.py.
+
+Loading the plugin happens in every CKAN process (web workers and CLI),
+so it should not pull in the action logic and its dependencies.
+"""
+
+import inspect
+import os
+import subprocess
+import sys
+
+# Cumulative import time (microseconds) allowed for the plugin module,
+# on top of ckan.plugins which CKAN loads anyway.
+IMPORT_BUDGET_US = int(os.environ.get("PASSWORDLESS_IMPORT_BUDGET_US", 50000))
+
+LAZY_MODULES = [
+    "ckanext.passwordless_api.logic",
+    "ckanext.passwordless_api.util",
+    "ckanext.passwordless_api.mailer",
+    "ckanext.passwordless_api.profiling",
+    "ckanext.passwordless_api.store",
+]
+
+
+def _import_times(code: str):
+    """Run code with -X importtime, return {module: cumulative_us}."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def test_plugin_import_does_not_load_logic():
+    """The action logic is only imported when an action is called."""
+    times = _import_times(
+        "import ckan.plugins; import ckanext.passwordless_api.plugin as p; "
+        "plugin = p.PasswordlessAPIPlugin(); plugin.update_config({}); "
+        "plugin.get_actions()"
+    )
+    for module in LAZY_MODULES:
+        assert module not in times, f"{module} imported at plugin load"
+
+
+def test_plugin_import_time_budget():
+    """Importing the plugin stays within the time budget."""
+    times = _import_times("import ckan.plugins; import ckanext.passwordless_api.plugin")
+    cumulative = times["ckanext.passwordless_api.plugin"]
+    assert (
+        cumulative < IMPORT_BUDGET_US
+    ), f"plugin import took {cumulative}us, budget {IMPORT_BUDGET_US}us"
+
+
+def test_lazy_actions_keep_docstrings():
+    """Actions have the logic.py docstrings, e.g. for help_show."""
+    from ckanext.passwordless_api import logic, plugin
+
+    for name, action in plugin.PasswordlessAPIPlugin().get_actions().items():
+        function = getattr(logic, plugin.ACTIONS[name][0])
+        assert action.__doc__ == inspect.cleandoc(function.__doc__), name
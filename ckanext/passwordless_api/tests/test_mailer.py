@@ -0,0 +1,106 @@
+"""Tests for mailer.py."""
+
+import logging
+import socketserver
+import threading
+from time import perf_counter
+
+import pytest
+from ckan import model
+from ckan.tests import factories, helpers
+
+from ckanext.passwordless_api import mailer
+
+log = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def sent_mails(monkeypatch):
+    """Record sent emails, instead of sending them."""
+    sent = []
+
+    def mail_user(user, subject, body):
+        sent.append({"subject": subject, "body": body})
+
+    monkeypatch.setattr(mailer.mailer, "mail_user", mail_user)
+    return sent
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server, accepting all mail."""
+
+    def handle(self):
+        self.server.connections += 1
+        self.wfile.write(b"220 localhost SMTP stub\r\n")
+        while line := self.rfile.readline():
+            command = line.strip().upper()
+            if command == b"DATA":
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.server.messages += 1
+                self.wfile.write(b"250 OK\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+
+@pytest.fixture
+def smtp_stub(ckan_config, monkeypatch):
+    """Local SMTP server counting connections and messages."""
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _SMTPHandler)
+    server.daemon_threads = True
+    server.connections = server.messages = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    address = f"127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setitem(ckan_config, "smtp.server", address)
+    monkeypatch.setitem(ckan_config, "smtp.test_server", address)
+    monkeypatch.setitem(ckan_config, "smtp.starttls", False)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.usefixtures("clean_db", "with_request_context")
+def test_welcome_and_reset_key_in_one_email(sent_mails):
+    """The combined email contains the welcome and the login token."""
+    user = model.User.get(factories.User(fullname="New User")["id"])
+
+    mailer.send_welcome_and_reset_key(user)
+
+    assert len(sent_mails) == 1
+    body = sent_mails[0]["body"]
+    assert "Welcome to" in body
+    assert user.reset_key in body
+    assert "Guidelines: None" not in body
+    # A single letter, not the two emails concatenated
+    assert body.count("Dear New User") == 1
+    assert body.count("Message sent by") == 1
+    assert "disregard this email" not in body
+
+
+@pytest.mark.ckan_config("ckan.plugins", "passwordless_api")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_redis")
+@pytest.mark.usefixtures("with_request_context")
+def test_first_login_latency_benchmark(smtp_stub, ckan_config, monkeypatch):
+    """A first login sends one email instead of two, when combined."""
+    connections = {}
+    timings = {}
+    for combined in ("false", "true"):
+        monkeypatch.setitem(
+            ckan_config, "passwordless_api.combined_welcome_email", combined
+        )
+        smtp_stub.connections = smtp_stub.messages = 0
+
+        start = perf_counter()
+        helpers.call_action(
+            "passwordless_request_reset_key", email=f"first-{combined}@example.com"
+        )
+        timings[combined] = round((perf_counter() - start) * 1000, 1)
+        connections[combined] = (smtp_stub.connections, smtp_stub.messages)
+
+    log.info("First login request_reset_key (ms), combined: %s", timings)
+    assert connections == {"false": (2, 2), "true": (1, 1)}
@@ -0,0 +1,28 @@
+"""Tests for sampled action profiling in profiling.py."""
+
+from cProfile import Profile
+
+import pytest
+
+from ckanext.passwordless_api import profiling
+
+HEADER = "X-Passwordless-Profile"
+
+
+@pytest.mark.ckan_config("passwordless_api.profile_secret", "secret")
+def test_profile_header(app):
+    """Only the configured secret enables profiling, other values are ignored."""
+    for value, expected in (("secret", True), ("wrong", False), ("sécret", False)):
+        with app.flask_app.test_request_context(headers={HEADER: value}):
+            assert profiling.should_profile() is expected
+
+
+@pytest.mark.ckan_config("passwordless_api.profile_max_files", "3")
+def test_profiles_are_pruned(tmp_path, ckan_config, monkeypatch):
+    """The profile directory keeps at most profile_max_files profiles."""
+    monkeypatch.setitem(ckan_config, "passwordless_api.profile_dir", str(tmp_path))
+
+    for _ in range(5):
+        profiling._write_profile(Profile(), "passwordless_get_user")
+
+    assert len(list(tmp_path.glob("*.pstats"))) == 3
@@ -0,0 +1,97 @@
+"""Tests for refresh token rotation in refresh.py."""
+
+import pytest
+from ckan import model
+from ckan.lib.api_token import decode as jwt_decode
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.passwordless_api import refresh
+
+pytestmark = [
+    pytest.mark.ckan_config("ckan.plugins", "passwordless_api expire_api_token"),
+    pytest.mark.ckan_config("passwordless_api.refresh_tokens", "true"),
+    pytest.mark.usefixtures("with_plugins", "clean_db", "clean_redis"),
+]
+
+
+def _is_active(token):
+    return model.ApiToken.get(jwt_decode(token)["jti"]) is not None
+
+
+@pytest.fixture
+def user():
+    """A new user."""
+    return factories.User()
+
+
+@pytest.fixture
+def issued(user):
+    """API token and refresh token from a login."""
+    return refresh.issue(user["id"])
+
+
+def test_rotate_replaces_both_tokens(issued):
+    """The refresh token is exchanged once, the previous API token revoked."""
+    rotated = refresh.rotate(issued["refresh_token"])
+
+    assert rotated["refresh_token"] != issued["refresh_token"]
+    assert _is_active(rotated["token"])
+    assert not _is_active(issued["token"])
+
+
+def test_reused_refresh_token_revokes_family(issued):
+    """Reusing a rotated refresh token revokes the whole login session."""
+    rotated = refresh.rotate(issued["refresh_token"])
+
+    with pytest.raises(toolkit.NotAuthorized):
+        refresh.rotate(issued["refresh_token"])
+
+    assert not _is_active(rotated["token"])
+    with pytest.raises(toolkit.NotAuthorized):
+        refresh.rotate(rotated["refresh_token"])
+
+
+def test_revoked_family_cannot_rotate(issued):
+    """Logout revokes the refresh token and its API token."""
+    assert refresh.revoke(issued["refresh_token"])
+
+    assert not _is_active(issued["token"])
+    with pytest.raises(toolkit.NotAuthorized):
+        refresh.rotate(issued["refresh_token"])
+
+
+def test_invalid_refresh_token(issued):
+    """Unknown or malformed refresh tokens are rejected."""
+    family, _ = issued["refresh_token"].split(".")
+
+    with pytest.raises(toolkit.NotAuthorized):
+        refresh.rotate(f"{family}.wrong")
+    with pytest.raises(toolkit.ValidationError):
+        refresh.rotate("malformed")
+
+    # The valid refresh token still works
+    assert refresh.rotate(issued["refresh_token"])
+
+
+@pytest.mark.ckan_config("passwordless_api.cookie_name", "ckan_token")
+def test_refresh_token_from_cookie(app):
+    """The refresh token is read from the cookie, if not in the request data."""
+    headers = {"Cookie": "ckan_token_refresh=family.secret"}
+    with app.flask_app.test_request_context(headers=headers):
+        assert refresh.get_refresh_token({}) == "family.secret"
+        assert refresh.get_refresh_token({"refresh_token": "a.b"}) == "a.b"
+
+    with app.flask_app.test_request_context():
+        assert refresh.get_refresh_token({}) is None
+
+
+def test_get_user_does_not_renew(user, issued):
+    """passwordless_get_user leaves the family API token as the only one."""
+    result = helpers.call_action(
+        "passwordless_get_user", context={"user": user["name"]}
+    )
+
+    assert result["user"]["id"] == user["id"]
+    assert "token" not in result
+    assert _is_active(issued["token"])
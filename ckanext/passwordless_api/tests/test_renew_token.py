@@ -0,0 +1,68 @@
+"""Tests for concurrent API token renewal in util.py."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from ckan import model
+from ckan.lib.api_token import decode as jwt_decode
+from ckan.plugins import toolkit
+from ckan.tests import factories
+
+from ckanext.passwordless_api import util
+
+CONCURRENT_CALLERS = 50
+
+
+def _renew(user_id):
+    try:
+        return util.renew_main_token_shared(user_id, 3, 86400)
+    finally:
+        model.Session.remove()
+
+
+@pytest.mark.ckan_config("ckan.plugins", "passwordless_api expire_api_token")
+@pytest.mark.ckan_config("passwordless_api.renew_coalesce_seconds", "5")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_redis")
+def test_concurrent_renewals_share_one_token():
+    """Concurrent callers get the same token, which is not revoked."""
+    user = factories.User()
+
+    with ThreadPoolExecutor(max_workers=CONCURRENT_CALLERS) as executor:
+        results = list(executor.map(_renew, [user["id"]] * CONCURRENT_CALLERS))
+
+    tokens = {result["token"] for result in results}
+    assert len(tokens) == 1
+
+    api_tokens = toolkit.get_action("api_token_list")(
+        context={"ignore_auth": True}, data_dict={"user": user["id"]}
+    )
+    assert [token["name"] for token in api_tokens] == ["main"]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "passwordless_api expire_api_token")
+@pytest.mark.ckan_config("passwordless_api.renew_coalesce_seconds", "5")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_redis")
+def test_login_during_window_clears_shared_token():
+    """A login revoking the shared token also drops it from the cache."""
+    user = factories.User()
+    shared = util.renew_main_token_shared(user["id"], 3, 86400)
+
+    # Login within the coalescing window, e.g. in another browser
+    util.renew_main_token(user["id"], 3, 86400)
+
+    renewed = util.renew_main_token_shared(user["id"], 3, 86400)
+    assert renewed["token"] != shared["token"]
+    assert model.ApiToken.get(jwt_decode(renewed["token"])["jti"])
+
+
+@pytest.mark.ckan_config("ckan.plugins", "passwordless_api expire_api_token")
+@pytest.mark.ckan_config("passwordless_api.renew_coalesce_seconds", "0")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_redis")
+def test_renewal_not_shared_if_disabled():
+    """Each caller rotates the token if coalescing is disabled."""
+    user = factories.User()
+
+    first = util.renew_main_token_shared(user["id"], 3, 86400)
+    second = util.renew_main_token_shared(user["id"], 3, 86400)
+
+    assert first["token"] != second["token"]
@@ -0,0 +1,126 @@
+"""Tests for read replica routing in replica.py."""
+
+import pytest
+from ckan.lib.api_token import decode as jwt_decode
+from ckan.model import ApiToken, User
+from ckan.tests import factories
+from sqlalchemy import create_engine, inspect, text
+
+from ckanext.passwordless_api import replica, util
+
+# User only in the replica, e.g. deleted on the primary
+REPLICA_USER = {
+    "id": "replica-user-id",
+    "name": "replica-user",
+    "email": "replica-user@example.com",
+}
+
+
+def _make_db(path, name):
+    """Create an SQLite database with a single row naming it."""
+    url = f"sqlite:///{path}"
+    with create_engine(url).begin() as conn:
+        conn.execute(text("CREATE TABLE db_name (name TEXT)"))
+        conn.execute(text("INSERT INTO db_name VALUES (:name)"), {"name": name})
+    return url
+
+
+def _db_name(session):
+    return session.execute(text("SELECT name FROM db_name")).scalar()
+
+
+@pytest.fixture
+def replica_db(tmp_path, ckan_config, monkeypatch):
+    """Configure an SQLite replica, next to the CKAN test (primary) database."""
+    replica_url = _make_db(tmp_path / "replica.db", "replica")
+    monkeypatch.setitem(ckan_config, "passwordless_api.replica_url", replica_url)
+    monkeypatch.setattr(replica, "_session", None)
+    replica.reset()
+    yield
+    replica.reset()
+
+
+@pytest.fixture
+def replica_users(tmp_path, ckan_config, monkeypatch):
+    """Configure an SQLite replica with a user table, holding REPLICA_USER.
+
+    Users created in the test (primary) database are not in the replica.
+    """
+    replica_url = f"sqlite:///{tmp_path / 'replica_users.db'}"
+    table = inspect(User).local_table
+    columns = ", ".join(f'"{column.name}"' for column in table.columns)
+    with create_engine(replica_url).begin() as conn:
+        conn.execute(text(f'CREATE TABLE "{table.name}" ({columns})'))
+        conn.execute(
+            text(
+                f'INSERT INTO "{table.name}" (id, name, email, state, sysadmin) '
+                "VALUES (:id, :name, :email, 'active', 0)"
+            ),
+            REPLICA_USER,
+        )
+
+    monkeypatch.setitem(ckan_config, "passwordless_api.replica_url", replica_url)
+    monkeypatch.setattr(replica, "_session", None)
+    replica.reset()
+    yield
+    replica.reset()
+
+
+def test_reads_use_replica(replica_db):
+    """Read-only lookups go to the replica."""
+    assert _db_name(replica.read_session()) == "replica"
+
+
+def test_reads_after_write_use_primary(replica_db):
+    """Reads go to the primary after the plugin wrote in the same request."""
+    replica.mark_written()
+    assert replica.read_session() is None
+
+    # Next request
+    replica.reset()
+    assert _db_name(replica.read_session()) == "replica"
+
+
+def test_no_replica_configured(ckan_config, monkeypatch):
+    """Without a replica, lookups use the primary session."""
+    monkeypatch.setitem(ckan_config, "passwordless_api.replica_url", "")
+    monkeypatch.setattr(replica, "_session", None)
+    assert replica.read_session() is None
+
+
+@pytest.mark.usefixtures("clean_db", "replica_users")
+def test_user_lookups_use_replica():
+    """Read-only user lookups find the replica users only."""
+    user = factories.User()
+
+    assert util.get_user_from_email(REPLICA_USER["email"], readonly=True)
+    assert not util.get_user_from_email(user["email"], readonly=True)
+    assert util.user_exists(REPLICA_USER["name"])
+    assert not util.user_exists(user["name"])
+
+    # Not read-only, e.g. to create a reset key
+    assert not util.get_user_from_email(REPLICA_USER["email"])
+    assert util.get_user_from_email(user["email"])
+
+
+@pytest.mark.usefixtures("clean_db", "replica_users")
+def test_user_lookups_after_write_use_primary():
+    """User lookups go to the primary after the plugin wrote."""
+    user = factories.User()
+    replica.mark_written()
+
+    assert util.get_user_from_email(user["email"], readonly=True)
+    assert util.user_exists(user["name"])
+    assert not util.user_exists(REPLICA_USER["name"])
+
+
+@pytest.mark.ckan_config("ckan.plugins", "passwordless_api expire_api_token")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_redis", "replica_users")
+def test_token_renewal_lists_tokens_from_primary():
+    """The token to revoke is found, although missing from the replica."""
+    user = factories.User()
+    token = factories.APIToken(user=user["name"], name="main")["token"]
+
+    util.renew_main_token(user["id"], 3, 86400)
+
+    assert ApiToken.get(jwt_decode(token)["jti"]) is None
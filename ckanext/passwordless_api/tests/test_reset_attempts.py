@@ -0,0 +1,38 @@
+"""Tests for the token request rate limit in util.py."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.passwordless_api import util
+
+CONCURRENT_CALLERS = 20
+EMAIL = "attempts@example.com"
+
+
+def _allowed(email):
+    try:
+        util.check_reset_attempts(email)
+    except toolkit.ValidationError:
+        return False
+    return True
+
+
+@pytest.mark.usefixtures("clean_redis")
+def test_concurrent_first_attempts_allow_one():
+    """Concurrent first requests for an email are not all allowed."""
+    with ThreadPoolExecutor(max_workers=CONCURRENT_CALLERS) as executor:
+        results = list(executor.map(_allowed, [EMAIL] * CONCURRENT_CALLERS))
+
+    assert results.count(True) == 1
+
+
+@pytest.mark.usefixtures("clean_redis")
+def test_attempts_cleared_after_login():
+    """A new request is allowed once the attempts are cleared."""
+    assert _allowed(EMAIL)
+    assert not _allowed(EMAIL)
+
+    util.clear_reset_attempts(EMAIL)
+    assert _allowed(EMAIL)
@@ -0,0 +1,44 @@
+"""Tests for the revoked tokens snapshot in revocation.py."""
+
+from datetime import datetime, timezone
+
+import pytest
+
+from ckanext.passwordless_api import revocation, store
+from ckanext.passwordless_api.verifier import BloomFilter
+
+
+def _now():
+    return datetime.now(timezone.utc).timestamp()
+
+
+@pytest.mark.usefixtures("clean_redis")
+def test_snapshot_contains_revoked_jtis():
+    """All revoked jtis are in the snapshot Bloom filter."""
+    jtis = [f"jti-{i}" for i in range(100)]
+    for jti in jtis:
+        revocation.add(jti, _now() + 3600)
+
+    snapshot = revocation.build_snapshot()
+    bloom = BloomFilter.from_dict(snapshot["bloom"])
+
+    assert snapshot["count"] == len(jtis)
+    assert all(jti in bloom for jti in jtis)
+    assert revocation.is_revoked("jti-0")
+    assert not revocation.is_revoked("not-revoked")
+
+
+@pytest.mark.usefixtures("clean_redis")
+def test_expired_jtis_are_pruned():
+    """Jtis of tokens that have expired anyway are dropped."""
+    revocation.add("expired", _now() - 1)
+    assert store.connect().zscore(revocation._revoked_key(), "expired") is None
+
+    # Expired since it was recorded
+    store.connect().zadd(revocation._revoked_key(), {"expired": _now() - 1})
+    assert not revocation.is_revoked("expired")
+    assert revocation.build_snapshot()["count"] == 0
+
+    revocation.add("current", _now() + 3600)
+    assert store.connect().zscore(revocation._revoked_key(), "expired") is None
+    assert revocation.build_snapshot()["count"] == 1
@@ -0,0 +1,62 @@
+"""Tests for the action trace recorder in trace.py."""
+
+import json
+import os
+from hashlib import sha256
+
+import pytest
+
+from ckanext.passwordless_api import trace
+
+EMAIL = "traced@example.com"
+
+
+@pytest.fixture
+def trace_file(tmp_path, ckan_config, monkeypatch):
+    """Record traces to a temporary file, return the file of this process."""
+    path = tmp_path / "trace.jsonl"
+    monkeypatch.setitem(ckan_config, "passwordless_api.trace_file", str(path))
+    monkeypatch.setitem(ckan_config, "passwordless_api.trace_salt", "salt")
+    monkeypatch.setattr(trace, "_trace_log", None)
+    yield tmp_path / f"trace.{os.getpid()}.jsonl"
+    if trace._trace_log is not None:
+        for handler in trace._trace_log.handlers[:]:
+            handler.close()
+            trace._trace_log.removeHandler(handler)
+
+
+def _records(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def _action(context, data_dict):
+    with trace.phase("mail"):
+        pass
+    if data_dict.get("fail"):
+        raise ValueError("failed")
+    return "result"
+
+
+def test_records_action_calls(trace_file):
+    """Each call is recorded with its phases and a salted email hash."""
+    assert trace.call_action("test_action", _action, {}, {"email": EMAIL}) == ("result")
+    with pytest.raises(ValueError):
+        trace.call_action("test_action", _action, {}, {"email": EMAIL, "fail": 1})
+
+    first, second = _records(trace_file)
+    assert first["action"] == "test_action"
+    assert first["outcome"] == "ok"
+    assert second["outcome"] == "ValueError"
+    assert set(first["phases"]) == {"mail"}
+
+    # Same user, same hash, but not the unsalted email hash
+    assert first["email"] == second["email"]
+    assert first["email"] != sha256(EMAIL.encode()).hexdigest()[:16]
+    assert EMAIL not in trace_file.read_text()
+
+
+def test_phase_outside_traced_call(trace_file):
+    """Phases outside a traced action call are not recorded."""
+    with trace.phase("mail"):
+        pass
+    assert not trace_file.exists() or not _records(trace_file)
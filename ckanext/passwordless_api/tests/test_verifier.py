@@ -0,0 +1,86 @@
+"""Tests for offline token verification in verifier.py."""
+
+from uuid import uuid4
+
+import pytest
+
+from ckanext.passwordless_api.verifier import (
+    BloomFilter,
+    TokenRevokedError,
+    TokenVerifier,
+    load_secret,
+)
+
+SECRET = "test-secret"
+
+
+def test_bloom_filter_round_trip():
+    """A filter serialised with to_dict loads with the same items."""
+    bloom = BloomFilter.for_capacity(100, 0.01)
+    for jti in ("a", "b", "c"):
+        bloom.add(jti)
+
+    loaded = BloomFilter.from_dict(bloom.to_dict())
+
+    assert (loaded.size, loaded.hashes) == (bloom.size, bloom.hashes)
+    assert loaded.bits == bloom.bits
+    assert all(jti in loaded for jti in ("a", "b", "c"))
+
+
+def test_bloom_filter_no_false_negatives():
+    """Every added item is found, false positives stay near the error rate."""
+    jtis = [uuid4().hex for _ in range(2000)]
+    bloom = BloomFilter.for_capacity(len(jtis), 0.01)
+    for jti in jtis:
+        bloom.add(jti)
+
+    assert all(jti in bloom for jti in jtis)
+    others = [uuid4().hex for _ in range(2000)]
+    assert sum(jti in bloom for jti in others) < len(others) * 0.05
+
+
+def test_load_secret(tmp_path):
+    """Secrets are loaded as in the CKAN config."""
+    secret_file = tmp_path / "secret"
+    secret_file.write_bytes(b"from-file")
+
+    assert load_secret(f"string:{SECRET}") == SECRET
+    assert load_secret(f"file:{secret_file}") == b"from-file"
+    assert load_secret(SECRET) == SECRET
+
+
+@pytest.fixture
+def verifier(monkeypatch):
+    """Verifier with a revoked jti, counting calls to CKAN."""
+    jwt = pytest.importorskip("jwt")
+
+    bloom = BloomFilter.for_capacity(10, 0.001)
+    bloom.add("revoked")
+    calls = []
+
+    def get(params=None):
+        calls.append(params)
+        if params:
+            return {"jti": params["jti"], "revoked": params["jti"] == "revoked"}
+        return {"bloom": bloom.to_dict()}
+
+    verifier = TokenVerifier(f"string:{SECRET}", "https://ckan.example.com")
+    monkeypatch.setattr(verifier, "_get", get)
+    verifier.calls = calls
+    verifier.encode = lambda jti: jwt.encode({"jti": jti}, SECRET, algorithm="HS256")
+    return verifier
+
+
+def test_verifier_accepts_valid_token(verifier):
+    """A valid token is verified without asking CKAN about the jti."""
+    assert verifier.verify(verifier.encode("valid"))["jti"] == "valid"
+    assert verifier.verify(verifier.encode("other"))["jti"] == "other"
+    # Only the snapshot was fetched, once
+    assert verifier.calls == [None]
+
+
+def test_verifier_rejects_revoked_token(verifier):
+    """A revoked token is confirmed with CKAN and rejected."""
+    with pytest.raises(TokenRevokedError):
+        verifier.verify(verifier.encode("revoked"))
+    assert verifier.calls == [None, {"jti": "revoked"}]
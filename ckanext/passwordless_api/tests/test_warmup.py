@@ -0,0 +1,94 @@
+"""Tests for warmup.py."""
+
+import logging
+import threading
+from time import perf_counter
+
+import click
+import pytest
+from ckan.tests import helpers
+from flask import Flask
+
+from ckanext.passwordless_api import mailer, warmup
+
+log = logging.getLogger(__name__)
+
+
+def _template_cached(flask_app, template_name):
+    return any(key[1] == template_name for key in flask_app.jinja_env.cache.keys())
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_redis")
+def test_warmup_renders_templates(app):
+    """After the warm-up, the email templates are compiled and cached."""
+    flask_app = app.flask_app
+    flask_app.jinja_env.cache.clear()
+
+    timings = warmup.run(flask_app)
+    log.info("Warm-up steps (ms): %s", timings)
+
+    assert set(timings) == {"modules", "templates", "redis", "graph"}
+    assert _template_cached(flask_app, "reset_key.txt")
+    assert _template_cached(flask_app, "welcome_user.txt")
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    """Record warm-up runs, instead of running them."""
+    calls = []
+    done = threading.Event()
+
+    def run(app):
+        calls.append(app)
+        done.set()
+
+    monkeypatch.setattr(warmup, "run", run)
+    calls.done = done
+    return calls
+
+
+def test_warmup_runs_when_app_is_loaded(runs):
+    """In a web server, the warm-up runs before the first request."""
+    flask_app = Flask(__name__)
+
+    warmup.schedule(flask_app)
+
+    assert runs == [flask_app]
+
+
+def test_warmup_in_cli_starts_on_first_request(runs):
+    """In CLI commands, the warm-up only runs from the first request."""
+    flask_app = Flask(__name__)
+
+    with click.Context(click.Command("run")):
+        warmup.schedule(flask_app)
+    assert not runs
+
+    client = flask_app.test_client()
+    client.get("/")
+    client.get("/")
+    assert runs.done.wait(5)
+    assert runs == [flask_app]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "passwordless_api")
+@pytest.mark.usefixtures("with_plugins", "clean_db", "clean_redis")
+def test_first_request_latency_cold_vs_warm(ckan_config, monkeypatch):
+    """Time the same first request on a fresh app, without and with warm-up."""
+    monkeypatch.setattr(mailer.mailer, "mail_user", lambda *args: None)
+
+    timings = {}
+    for warm in ("false", "true"):
+        monkeypatch.setitem(ckan_config, "passwordless_api.warmup", warm)
+        test_app = helpers._get_test_app()
+        cached = _template_cached(test_app.flask_app, "reset_key.txt")
+
+        start = perf_counter()
+        test_app.post(
+            "/api/3/action/passwordless_request_reset_key",
+            json={"email": f"first-request-{warm}@example.com"},
+        )
+        timings[warm] = round((perf_counter() - start) * 1000, 1)
+        assert cached is (warm == "true")
+
+    log.info("First request_reset_key request (ms), warm-up: %s", timings)
@@ -0,0 +1,118 @@
+"""Anonymised traces of passwordless action calls, to replay realistic load.
+
+Enabled with passwordless_api.trace_file. Each action call is written as one
+JSON line: action, start time, duration, hashed email, outcome and the time
+spent in each phase (see phase). Each process writes its own file (see
+process_trace_file), as file rotation is not safe across processes.
+Replay the traces with the 'ckan passwordless-api replay' command.
+"""
+
+import logging
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from hashlib import sha256
+from json import dumps as dump_json
+from logging.handlers import RotatingFileHandler
+from time import perf_counter, time
+
+from ckan.common import config
+
+log = logging.getLogger(__name__)
+
+# Phase timings (ms) of the action call being traced
+_phases = ContextVar("passwordless_api_trace_phases", default=None)
+
+# Logger writing to the trace file, created on first use
+_trace_log = None
+
+
+def enabled():
+    """Check if action calls are traced."""
+    return bool(config.get("passwordless_api.trace_file", None))
+
+
+def process_trace_file(trace_file: str, pid: int):
+    """Trace file of a process, e.g. 'trace.1234.jsonl' for 'trace.jsonl'."""
+    root, ext = os.path.splitext(trace_file)
+    return f"{root}.{pid}{ext}"
+
+
+def _get_trace_log():
+    global _trace_log
+
+    if _trace_log is None:
+        handler = RotatingFileHandler(
+            process_trace_file(config.get("passwordless_api.trace_file"), os.getpid()),
+            maxBytes=int(config.get("passwordless_api.trace_max_bytes", 10485760)),
+            backupCount=int(config.get("passwordless_api.trace_backup_count", 5)),
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _trace_log = logging.getLogger(f"{__name__}.records")
+        _trace_log.addHandler(handler)
+        _trace_log.setLevel(logging.INFO)
+        _trace_log.propagate = False
+    return _trace_log
+
+
+def hash_email(email):
+    """Anonymise an email, keeping the same hash for the same email.
+
+    Salted with passwordless_api.trace_salt (required with trace_file), so
+    hashes cannot be matched against hashes of known email addresses.
+    """
+    if not isinstance(email, str) or not email:
+        return None
+    salt = config.get("passwordless_api.trace_salt")
+    return sha256(f"{salt}{email.lower()}".encode()).hexdigest()[:16]
+
+
+@contextmanager
+def phase(name: str):
+    """Time a phase of the traced action call, e.g. 'mail'."""
+    if (phases := _phases.get()) is None:
+        yield
+        return
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0) + (perf_counter() - start) * 1000
+
+
+def call_action(action_name: str, function, context, data_dict):
+    """Call an action function, writing a trace record if enabled."""
+    if not enabled():
+        return function(context, data_dict)
+
+    phases = {}
+    phases_token = _phases.set(phases)
+    started_at = time()
+    start = perf_counter()
+    outcome = "ok"
+    try:
+        return function(context, data_dict)
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        duration = (perf_counter() - start) * 1000
+        _phases.reset(phases_token)
+        try:
+            _get_trace_log().info(
+                dump_json(
+                    {
+                        "action": action_name,
+                        "start": round(started_at, 6),
+                        "duration_ms": round(duration, 3),
+                        "email": hash_email(data_dict.get("email")),
+                        "outcome": outcome,
+                        "phases": {
+                            name: round(value, 3) for name, value in phases.items()
+                        },
+                    }
+                )
+            )
+        except Exception as e:
+            log.warning("Could not write trace record: %s", e)
@@ -1,19 +1,113 @@
 """Separated helper utils to keep logic file clean."""
 
 import logging
-from datetime import datetime, timedelta
+import os
+from datetime import datetime
+from hashlib import sha1
+from json import dumps as dump_json
 from json import loads as load_json
+from random import randrange
 from re import match as regexmatch
+from time import monotonic, sleep
 from uuid import uuid4
 
 from ckan import logic
 from ckan.common import config
-from ckan.lib.redis import connect_to_redis
-from ckan.model import User
+from ckan.lib.api_token import decode as jwt_decode
+from ckan.lib.api_token import encode as jwt_encode
+from ckan.model import Session, User
 from ckan.plugins import toolkit
-from dateutil import parser as dateparser
+from requests import Session as HTTPSession
+from sqlalchemy import func, or_
+
+from ckanext.passwordless_api import replica, revocation, store
+
 log = logging.getLogger(__name__)
 
+# Azure AD token verification endpoint
+GRAPH_ME_URL = "https://graph.microsoft.com/v1.0/me"
+
+# Pooled HTTP session, created on first use
+_http_session = None
+
+# User fields that can be requested via passwordless_get_user 'fields'
+USER_FIELDS = (
+    "id",
+    "name",
+    "fullname",
+    "display_name",
+    "email",
+    "email_hash",
+    "about",
+    "created",
+    "last_active",
+    "sysadmin",
+    "state",
+    "image_url",
+    "activity_streams_email_notifications",
+)
+
+
+# Count a token request attempt, unless still waiting after the previous one.
+# Waits base ^ attempts seconds after the latest attempt.
+# Returns the timestamp to wait until, or nil if the attempt is allowed.
+RESET_ATTEMPTS_SCRIPT = """
+local attempts = tonumber(redis.call('hget', KEYS[1], 'attempts')) or 0
+local latest = tonumber(redis.call('hget', KEYS[1], 'latest')) or 0
+local limit = latest + tonumber(ARGV[2]) ^ attempts
+if attempts > 0 and limit > tonumber(ARGV[1]) then
+    return tostring(limit)
+end
+redis.call('hset', KEYS[1], 'attempts', attempts + 1, 'latest', ARGV[1])
+return false
+"""
+
+# Keys with secret values, never to be logged
+SECRET_KEYS = ("key", "token", "refresh_token", "password", "reset_key", "apikey")
+
+
+class Redacted:
+    """Redact secrets from a value, only when it is formatted for logging.
+
+    Use with lazy logging, e.g. log.debug("params: %s", Redacted(data_dict)),
+    so nothing is formatted when the log level is disabled.
+    """
+
+    def __init__(self, value):
+        """Wrap a dict (secret keys are redacted) or a secret value."""
+        self.value = value
+
+    def __str__(self):
+        """Format the value with secrets replaced."""
+        if isinstance(self.value, dict):
+            return str(
+                {
+                    key: "***" if key in SECRET_KEYS else value
+                    for key, value in self.value.items()
+                }
+            )
+        return "***"
+
+
+def http_session():
+    """Get the pooled HTTP session, reusing connections (and TLS handshakes)."""
+    global _http_session
+
+    if _http_session is None:
+        _http_session = HTTPSession()
+    return _http_session
+
+
+def _reset_http_session():
+    """Drop the pooled HTTP session, so a forked process opens its own."""
+    global _http_session
+
+    _http_session = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_http_session)
+
 
 def email_is_valid(email: str):
     """Match an email against regex for validation."""
@@ -23,30 +117,109 @@ def email_is_valid(email: str):
     return False
 
 
-def get_user_from_email(email: str):
+def get_user_from_email(email: str, readonly: bool = False):
     """Get the CKAN user with the given email address.
 
+    Args:
+        email (str): Email of user.
+        readonly (bool): The user is not modified, may be read from the replica.
+
     Returns:
         dict: A CKAN user dict.
     """
     # make case insensitive
     email = email.lower()
-    log.debug(f"Getting user id for email: {email}")
+    log.debug("Getting user id for email: %s", email)
 
     # Workaround as action user_list requires sysadmin priviledge
     # to return emails (email_hash is returned otherwise, with no matches)
     # action user_show also doesn't return the reset_key...
     # by_email returns .first() item
-    user = User.by_email(email)
+    if readonly and (session := replica.read_session()):
+        user = session.query(User).filter(func.lower(User.email) == email).first()
+    else:
+        user = User.by_email(email)
 
     if user:
-        log.debug(f"Returning user id ({user.id}) for email {email}.")
+        log.debug("Returning user id (%s) for email %s.", user.id, email)
         return user
 
     log.warning(f"No matching users found for email: {email}")
     return None
 
 
+def parse_user_fields(fields):
+    """Parse the requested user fields, as list or comma separated string.
+
+    Returns:
+        list: Requested fields, or None if all fields are requested.
+    """
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    fields = [field.strip() for field in fields if field.strip()]
+
+    if invalid := [field for field in fields if field not in USER_FIELDS]:
+        raise toolkit.ValidationError(
+            {"fields": f"invalid user fields: {', '.join(invalid)}"}
+        )
+    return fields or None
+
+
+def get_user_fields(user_id: str, fields: list):
+    """Get only the given fields of a user, from the model directly.
+
+    Avoids the user_show dictization (created datasets count etc.).
+
+    Returns:
+        dict: Projected user dict, or None if the user does not exist.
+    """
+    session = replica.read_session() or Session
+    if not (
+        user := session.query(User)
+        .filter(or_(User.id == user_id, User.name == user_id))
+        .first()
+    ):
+        return None
+
+    user_dict = {}
+    for field in fields:
+        value = getattr(user, field)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        user_dict[field] = value
+    return user_dict
+
+
+def user_exists(user_id: str):
+    """Check if a user exists, given the user ID or name."""
+    if session := replica.read_session():
+        return (
+            session.query(User.id)
+            .filter(or_(User.id == user_id, User.name == user_id))
+            .first()
+            is not None
+        )
+
+    try:
+        toolkit.get_action("user_show")(
+            context={"ignore_auth": True}, data_dict={"id": user_id}
+        )
+    except logic.NotFound:
+        return False
+    return True
+
+
+def user_etag(user: dict):
+    """Generate an ETag from the user dict content.
+
+    last_active is excluded, as it changes without the user being modified.
+    """
+    content = {key: value for key, value in user.items() if key != "last_active"}
+    return sha1(dump_json(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
 def get_new_username(email: str):
     """Generate a new username and check does not exist."""
     email = email.lower()
@@ -68,14 +241,10 @@ def get_new_username(email: str):
 
     offset = 0
     while offset < 100000:
-        try:
-            toolkit.get_action("user_show")(
-                context={"ignore_auth": True},
-                data_dict={"id": username},
-            )
-            log.debug(f"User creation: {username} exists. Attempting next...")
-        except logic.NotFound:
-            log.debug(f"User creation: {username} does not exist. Creating...")
+        if user_exists(username):
+            log.debug("User creation: %s exists. Attempting next...", username)
+        else:
+            log.debug("User creation: %s does not exist. Creating...", username)
             return username
         offset += 1
         username = generate_user_name(email, offset)
@@ -124,26 +293,32 @@ def renew_main_token(user_id: str, expiry: int, units: int):
     Returns:
         str: API token for user.
     """
-    log.debug(f"Renewing API token 'main' for user id: {user_id}")
+    log.debug("Renewing API token 'main' for user id: %s", user_id)
 
     if isinstance(user_id, str):
         # check if there is one already and delete it
-        data_dict = {"user": user_id}
+        # read from the primary, a lagging replica could miss the latest token
         api_tokens = toolkit.get_action("api_token_list")(
-            context={"ignore_auth": True}, data_dict=data_dict
-        )
-        log.debug(
-            f"User ID {user_id}) API tokens: "
-            f"{', '.join([k['name'] for k in api_tokens])}"
+            context={"ignore_auth": True, "include_plugin_extras": True},
+            data_dict={"user": user_id},
         )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "User ID %s API tokens: %s",
+                user_id,
+                ", ".join([k["name"] for k in api_tokens]),
+            )
         for token in api_tokens:
             if token.get("name") == "main":
-                log.debug(f"Revoking API token {token}")
+                log.debug("Revoking API token %s", token["id"])
                 toolkit.get_action("api_token_revoke")(
                     context={"ignore_auth": True}, data_dict={"jti": token["id"]}
                 )
+                revocation.add(token["id"], revocation.token_expiry(token))
+        # A shared renewal cached before would return the revoked token
+        clear_shared_token(user_id)
 
-        log.debug("Generating API token for user with expiry: {}")
+        log.debug("Generating API token for user with expiry: %s * %s", expiry, units)
         new_api_key = toolkit.get_action("api_token_create")(
             context={"ignore_auth": True},
             data_dict={
@@ -153,78 +328,149 @@ def renew_main_token(user_id: str, expiry: int, units: int):
                 "unit": units,
             },
         )
-        log.debug(f"New API key: {new_api_key}")
+        replica.mark_written()
+        log.debug("New API key: %s", Redacted(new_api_key))
         return new_api_key
     else:
         return None
 
 
+def renew_main_token_shared(user_id: str, expiry: int, units: int):
+    """Renew the API token 'main' once for concurrent callers (single flight).
+
+    The first caller takes a short Redis lock and renews the token. The result
+    is cached for passwordless_api.renew_coalesce_seconds, so callers waiting
+    on the lock, or arriving within that window, get the same fresh token
+    instead of revoking each other's tokens.
+
+    Only the unsigned token claims are cached, the token is signed again
+    by each caller, so tokens cannot be collected from Redis.
+
+    Args:
+        user_id (str): User ID.
+        expiry (int): Token expires in.
+        units (int): Units for expiration time.
+
+    Returns:
+        dict: API token for user.
+
+    Raises:
+        toolkit.ValidationError: If a concurrent renewal did not finish in time.
+    """
+    window = float(config.get("passwordless_api.renew_coalesce_seconds", 5))
+    if window <= 0:
+        return renew_main_token(user_id, expiry, units)
+
+    redis_conn = store.connect()
+    result_key = store.key(f"renew:{user_id}", "result")
+    lock_key = store.key(f"renew:{user_id}", "lock")
+    lock_ttl_ms = 10000
+    deadline = monotonic() + 2 * lock_ttl_ms / 1000
+
+    while True:
+        if cached := redis_conn.get(result_key):
+            log.debug("Using API token renewed concurrently for user: %s", user_id)
+            return {"token": jwt_encode(load_json(cached))}
+        if monotonic() >= deadline:
+            break
+
+        if lock_token := store.acquire_lock(redis_conn, lock_key, lock_ttl_ms):
+            try:
+                new_api_key = renew_main_token(user_id, expiry, units)
+                if new_api_key and (claims := jwt_decode(new_api_key["token"])):
+                    redis_conn.set(result_key, dump_json(claims), px=int(window * 1000))
+                return new_api_key
+            finally:
+                store.release_lock(redis_conn, lock_key, lock_token)
+
+        sleep(0.02)
+
+    # Renewing without the lock would revoke the token shared with others
+    log.warning("Timed out waiting for concurrent token renewal: %s", user_id)
+    raise toolkit.ValidationError(
+        {"token": "token renewal already in progress, try again later"}
+    )
+
+
+def clear_shared_token(user_id: str):
+    """Remove the cached renewed token, e.g. when the user logs out.
+
+    Args:
+        user_id (str): User ID or name, the token is cached under either.
+    """
+    user_ids = {user_id}
+    if user := User.get(user_id):
+        user_ids.update((user.id, user.name))
+    store.connect().delete(
+        *[store.key(f"renew:{name_or_id}", "result") for name_or_id in user_ids]
+    )
+
+
 def check_reset_attempts(email: str):
-    """Check if token reset limit exceeded by user."""
-    redis_conn = connect_to_redis()
-    if email not in redis_conn.keys():
-        log.debug(f"Redis: first login attempt for {email}")
-        redis_conn.hmset(email, {"attempts": 1, "latest": datetime.now().isoformat()})
-    else:
-        base = 3
-        attempts = int(redis_conn.hmget(email, "attempts")[0])
-        latest = dateparser.parse(redis_conn.hmget(email, "latest")[0])
+    """Check if token reset limit exceeded by user.
 
-        waiting_seconds = base**attempts
-        limit_date = latest + timedelta(seconds=waiting_seconds)
+    The check and the attempt count update run atomically in Redis, so
+    concurrent requests for the same email cannot bypass the waiting time.
+    """
+    base = 3
+    now = datetime.now()
+    limit = store.connect().register_script(RESET_ATTEMPTS_SCRIPT)(
+        keys=[store.user_key(email, "attempts")], args=[now.timestamp(), base]
+    )
+    if limit is None:
+        log.debug("Redis: token request attempt allowed for %s", email)
+        return
+
+    limit_date = datetime.fromtimestamp(float(limit))
+    log.debug("Redis: wait until %s for %s", limit_date, email)
+    msg = (
+        "User should wait "
+        f"{int((limit_date - now).total_seconds())} "
+        f"seconds until {limit_date.isoformat()} for a new token request"
+    )
+    raise logic.ValidationError({"user": msg})
 
-        log.debug(
-            f"Redis: wait {waiting_seconds} seconds after {attempts} attempts "
-            f"=> after date {limit_date.isoformat()}"
-        )
 
-        if limit_date > datetime.now():
-            msg = (
-                "User should wait "
-                f"{int((limit_date - datetime.now()).total_seconds())} "
-                f"seconds until {limit_date.isoformat()} for a new token request"
-            )
-            raise logic.ValidationError({"user": msg})
-        else:
-            # increase counter
-            redis_conn.hmset(
-                email, {"attempts": attempts + 1, "latest": datetime.now().isoformat()}
-            )
+def clear_reset_attempts(email: str):
+    """Delete the token reset attempts for a user, after a successful login."""
+    log.debug("Redis: reset attempts for %s", email)
+    store.connect().delete(store.user_key(email, "attempts"))
 
 
 def check_new_user_quota():
-    """Check if signup limit exceeded by user."""
-    redis_conn = connect_to_redis()
-    new_users_list = "new_latest_users"
-    if "new_latest_users" not in redis_conn.keys():
-        redis_conn.lpush(new_users_list, datetime.now().isoformat())
-    else:
-        # TODO: read this rom config
-        max_new_users = 10
-        period = 60 * 10
-        begin_date = datetime.now() - timedelta(seconds=period)
-
-        count = 0
-        elements_to_remove = []
-
-        for i in range(0, redis_conn.llen(new_users_list)):
-            value = redis_conn.lindex(new_users_list, i)
-            new_user_creation_date = dateparser.parse(value)
-            if new_user_creation_date >= begin_date:
-                count += 1
-            else:
-                elements_to_remove += [value]
-
-        for value in elements_to_remove:
-            redis_conn.lrem(new_users_list, value)
-
-        if count >= max_new_users:
-            log.error(f"New user temporary quota exceeded. Count: {count}")
-            msg = (
-                f"New user temporary quota exceeded, wait {period / 60} "
-                "minutes for a new request."
-            )
-            raise logic.ValidationError({"user": msg})
-        else:
-            # add new user creation
-            redis_conn.lpush(new_users_list, datetime.now().isoformat())
+    """Check if signup limit exceeded by user.
+
+    New users are counted in time windows, spread over several shard counters
+    so no single key is hot in a Redis Cluster. The counters are summed on read,
+    using a sliding window approximation over the current and previous window.
+    """
+    redis_conn = store.connect()
+    max_new_users = int(config.get("passwordless_api.new_user_quota", 10))
+    period = int(config.get("passwordless_api.new_user_quota_period", 60 * 10))
+    shards = int(config.get("passwordless_api.new_user_quota_shards", 16))
+
+    now = datetime.now().timestamp()
+    window = int(now // period)
+    previous_weight = 1 - (now % period) / period
+
+    pipe = redis_conn.pipeline(transaction=False)
+    for shard in range(shards):
+        pipe.get(store.key(f"new_users:{shard}", str(window)))
+        pipe.get(store.key(f"new_users:{shard}", str(window - 1)))
+    counts = [int(value or 0) for value in pipe.execute()]
+    count = sum(counts[0::2]) + sum(counts[1::2]) * previous_weight
+
+    if count >= max_new_users:
+        log.error("New user temporary quota exceeded. Count: %.1f", count)
+        msg = (
+            f"New user temporary quota exceeded, wait {period / 60} "
+            "minutes for a new request."
+        )
+        raise logic.ValidationError({"user": msg})
+
+    # add new user creation
+    shard_key = store.key(f"new_users:{randrange(shards)}", str(window))
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.incr(shard_key)
+    pipe.expire(shard_key, period * 2)
+    pipe.execute()
@@ -0,0 +1,171 @@
+"""Verify CKAN API tokens offline, from services outside of CKAN.
+
+This module does not import CKAN. A service checks the JWT signature and
+expiry itself, then checks the token jti against a Bloom filter snapshot of
+revoked tokens, fetched from the passwordless_revocation_list action.
+Only on a Bloom filter hit is CKAN asked if the jti is really revoked.
+
+Tokens revoked after the latest snapshot are accepted until the next refresh,
+and tokens deleted outside this plugin (e.g. from the CKAN UI) are not known.
+Use passwordless_introspect where this is not acceptable.
+
+Example:
+    verifier = TokenVerifier(
+        secret="string:YOUR_SUPER_SECRET_STRING",
+        ckan_url="https://ckan.example.com",
+    )
+    payload = verifier.verify(token)
+"""
+
+import math
+from base64 import b64decode, b64encode
+from hashlib import sha256
+from time import monotonic
+
+
+class TokenRevokedError(Exception):
+    """The API token was revoked."""
+
+
+class BloomFilter:
+    """A fixed size Bloom filter, using double hashing over SHA256."""
+
+    def __init__(self, size: int, hashes: int, bits: bytes = None):
+        """Create an empty Bloom filter, or load it from its bits.
+
+        Args:
+            size (int): Number of bits.
+            hashes (int): Number of hash functions.
+            bits (bytes, optional): Existing filter bits.
+        """
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, error_rate: float):
+        """Create a Bloom filter sized for the capacity and false positive rate."""
+        capacity = max(capacity, 1)
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hashes = max(1, round(size / capacity * math.log(2)))
+        return cls(size, hashes)
+
+    def _positions(self, item: str):
+        digest = sha256(item.encode()).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:16], "big") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        """Add an item to the filter."""
+        for position in self._positions(item):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, item: str):
+        """Check if an item may be in the filter (no false negatives)."""
+        return all(
+            self.bits[position // 8] & (1 << (position % 8))
+            for position in self._positions(item)
+        )
+
+    def to_dict(self):
+        """Serialise the filter, e.g. for a JSON API response."""
+        return {
+            "size": self.size,
+            "hashes": self.hashes,
+            "bits": b64encode(bytes(self.bits)).decode(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Load a filter serialised with to_dict."""
+        return cls(data["size"], data["hashes"], b64decode(data["bits"]))
+
+
+def load_secret(secret: str):
+    """Load a secret as set in the CKAN config, like CKAN does.
+
+    Strips the 'string:' prefix, or reads a 'file:' prefixed secret from
+    the file. Other values are used as is.
+    """
+    if secret.startswith("file:"):
+        with open(secret[len("file:") :], "rb") as f:
+            return f.read()
+    if secret.startswith("string:"):
+        return secret[len("string:") :]
+    return secret
+
+
+class TokenVerifier:
+    """Verify CKAN API tokens locally, with a remote check on Bloom filter hits."""
+
+    def __init__(
+        self,
+        secret: str,
+        ckan_url: str,
+        algorithm: str = "HS256",
+        refresh_interval: int = 60,
+        timeout: int = 5,
+    ):
+        """Create a verifier.
+
+        Args:
+            secret (str): The CKAN api_token.jwt.decode.secret, as in the
+                config (with the 'string:' or 'file:' prefix).
+            ckan_url (str): CKAN base URL, to fetch revocations from.
+            algorithm (str): The CKAN api_token.jwt.algorithm.
+            refresh_interval (int): Seconds between revocation snapshot fetches.
+            timeout (int): Timeout in seconds for requests to CKAN.
+        """
+        from requests import Session
+
+        self.secret = load_secret(secret)
+        self.algorithm = algorithm
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.action_url = (
+            f"{ckan_url.rstrip('/')}/api/3/action/passwordless_revocation_list"
+        )
+        self._session = Session()
+        self._bloom = None
+        self._fetched_at = None
+
+    def _get(self, params=None):
+        response = self._session.get(
+            self.action_url, params=params, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()["result"]
+
+    def bloom_filter(self):
+        """Get the revoked tokens Bloom filter, refreshed if outdated."""
+        if (
+            self._bloom is None
+            or monotonic() - self._fetched_at > self.refresh_interval
+        ):
+            self._bloom = BloomFilter.from_dict(self._get()["bloom"])
+            self._fetched_at = monotonic()
+        return self._bloom
+
+    def is_revoked(self, jti: str):
+        """Check if a token jti is revoked, remotely only on Bloom filter hits."""
+        if jti not in self.bloom_filter():
+            return False
+        return self._get(params={"jti": jti})["revoked"]
+
+    def verify(self, token: str):
+        """Verify an API token signature, expiry and revocation.
+
+        Returns:
+            dict: The decoded token payload.
+
+        Raises:
+            jwt.InvalidTokenError: If the signature or expiry is invalid.
+            TokenRevokedError: If the token was revoked.
+        """
+        import jwt
+
+        payload = jwt.decode(token, self.secret, algorithms=[self.algorithm])
+        if self.is_revoked(payload["jti"]):
+            raise TokenRevokedError(f"API token {payload['jti']} was revoked")
+        return payload
@@ -0,0 +1,150 @@
+"""Warm up a worker before its first passwordless request.
+
+Enabled with passwordless_api.warmup. Loads the plugin modules, renders the
+email templates for each configured locale, opens the Redis connection and
+loads the Lua scripts, and optionally opens the Microsoft Graph connection.
+Runs before the first request of each web worker, not in CLI commands:
+after fork under uWSGI, otherwise when the app is loaded and again in each
+forked worker (e.g. gunicorn with --preload).
+"""
+
+import logging
+import os
+from importlib import import_module
+from json import loads as load_json
+from threading import Lock, Thread
+from time import perf_counter
+
+import click
+from ckan.common import config
+
+log = logging.getLogger(__name__)
+
+# Placeholder user to render the email templates with
+WARMUP_USER = {
+    "name": "warmup",
+    "fullname": "Warm Up",
+    "email": "warmup@example.com",
+}
+
+
+def _locales():
+    """Locales to render the email templates for."""
+    if locales := config.get("passwordless_api.warmup_locales", None):
+        return locales.split()
+    return [config.get("ckan.locale_default", "en")]
+
+
+def _render_templates(app):
+    from flask_babel import force_locale
+
+    from ckanext.passwordless_api import mailer
+
+    with app.test_request_context():
+        for locale in _locales():
+            with force_locale(locale):
+                mailer._get_user_reset_key_body(WARMUP_USER, "warmup")
+                mailer._get_welcome_email_body(WARMUP_USER)
+                if mailer.combined_welcome_email():
+                    mailer._get_welcome_and_reset_key_body(WARMUP_USER, "warmup")
+
+
+def _connect_redis():
+    from ckanext.passwordless_api import refresh, store, util
+
+    redis_conn = store.connect()
+    redis_conn.ping()
+    for script in (
+        store.RELEASE_LOCK_SCRIPT,
+        util.RESET_ATTEMPTS_SCRIPT,
+        refresh.ROTATE_SCRIPT,
+        refresh.SET_ACCESS_SCRIPT,
+    ):
+        redis_conn.script_load(script)
+
+
+def _connect_graph():
+    from ckanext.passwordless_api import util
+
+    if bool(load_json(config.get("passwordless_api.warmup_graph", "false"))):
+        util.http_session().head(util.GRAPH_ME_URL, timeout=5)
+
+
+def run(app):
+    """Warm up the worker, each step failing independently.
+
+    Returns:
+        dict: Duration of each step in ms.
+    """
+    steps = {
+        "modules": lambda: import_module("ckanext.passwordless_api.logic"),
+        "templates": lambda: _render_templates(app),
+        "redis": _connect_redis,
+        "graph": _connect_graph,
+    }
+
+    timings = {}
+    for name, step in steps.items():
+        start = perf_counter()
+        try:
+            step()
+        except Exception as e:
+            log.warning("Passwordless warm-up step %s failed: %s", name, e)
+        timings[name] = round((perf_counter() - start) * 1000, 1)
+
+    log.info("Passwordless warm-up done (ms): %s", timings)
+    return timings
+
+
+def _uwsgi_lazy_apps(uwsgi):
+    """Whether uWSGI loads the app in each worker, after fork."""
+    return any(
+        uwsgi.opt.get(option) not in (None, False, b"false", "false")
+        for option in ("lazy-apps", "lazy")
+    )
+
+
+def _on_first_request(app):
+    """Start the warm-up in the background on the first request."""
+    # Never released, so only the first request starts the warm-up
+    started = Lock()
+
+    @app.before_request
+    def start_warmup():
+        if started.acquire(blocking=False):
+            Thread(
+                target=run, args=(app,), name="passwordless-warmup", daemon=True
+            ).start()
+
+
+def schedule(app):
+    """Run the warm-up in each web worker, before its first request.
+
+    In CLI commands, only starts on the first request ('ckan run'). Under
+    uWSGI, runs after fork, or right away with lazy-apps. Otherwise runs right
+    away, in the worker or in the preloading master, and again in each worker
+    forked from it, which must not share the master's connections.
+    """
+    if click.get_current_context(silent=True) is not None:
+        _on_first_request(app)
+        return
+
+    try:
+        import uwsgi
+        from uwsgidecorators import postfork
+    except ImportError:
+        pass
+    else:
+        if _uwsgi_lazy_apps(uwsgi):
+            log.warning(
+                "uWSGI lazy-apps: postfork hooks do not fire for the app, "
+                "passwordless warm-up runs now in the worker"
+            )
+            run(app)
+        else:
+            postfork(lambda: run(app))
+        return
+
+    run(app)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=lambda: run(app))